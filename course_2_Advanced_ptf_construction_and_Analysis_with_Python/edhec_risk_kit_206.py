@@ -257,6 +257,295 @@ def var_gaussian(r, level=5, modified=False):
     return -(r.mean() + z*r.std(ddof=0))
 
 
+import copy
+import hashlib
+import inspect
+import os
+import pickle
+import types
+from collections import OrderedDict
+from functools import partial, wraps
+
+def _hash_update(h, obj):
+    """
+    Feeds a canonical byte representation of obj into the hash object h
+    Arrays are hashed on their raw bytes, pandas objects on their values and labels
+    """
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            h.update(pickle.dumps(obj.tolist()))
+        else:
+            h.update(f"ndarray{obj.dtype.str}{obj.shape}".encode())
+            h.update(np.ascontiguousarray(obj))
+    elif isinstance(obj, pd.Index):
+        h.update(f"index{obj.name!r}".encode())
+        _hash_update(h, pd.util.hash_pandas_object(obj, index=False).to_numpy())
+    elif isinstance(obj, pd.Series):
+        h.update(f"series{obj.name!r}".encode())
+        _hash_update(h, obj.index)
+        _hash_update(h, obj.to_numpy())
+    elif isinstance(obj, pd.DataFrame):
+        h.update(b"frame")
+        _hash_update(h, obj.index)
+        _hash_update(h, obj.columns)
+        _hash_update(h, obj.to_numpy())
+    elif obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, np.generic)):
+        h.update(repr((type(obj).__name__, obj)).encode())
+    elif isinstance(obj, (tuple, list)):
+        h.update(f"{type(obj).__name__}{len(obj)}".encode())
+        for item in obj:
+            _hash_update(h, item)
+    elif isinstance(obj, dict):
+        h.update(f"dict{len(obj)}".encode())
+        for k in sorted(obj, key=repr):
+            _hash_update(h, k)
+            _hash_update(h, obj[k])
+    elif isinstance(obj, (set, frozenset)):
+        h.update(f"{type(obj).__name__}{len(obj)}".encode())
+        for item in sorted(obj, key=repr):
+            _hash_update(h, item)
+    elif callable(obj):
+        _hash_callable(h, obj)
+    elif hasattr(obj, "__dict__"):
+        h.update(f"object{type(obj).__qualname__}".encode())
+        _hash_update(h, vars(obj))
+    else:
+        h.update(pickle.dumps(obj))
+
+def _hash_callable(h, func, seen=None):
+    """
+    Feeds a callable into the hash object h. Functions are hashed on their code, defaults and
+    closure contents (so two lambdas or closures with different bodies or captured values differ),
+    partials on their function and bound arguments, methods on their function and instance.
+    Raises a TypeError for other callable objects, which have no reliable content to hash
+    """
+    seen = set() if seen is None else seen
+    if id(func) in seen:
+        # a closure that refers to itself
+        h.update(b"recursive")
+        return
+    seen.add(id(func))
+    if isinstance(func, partial):
+        h.update(b"partial")
+        _hash_callable(h, func.func, seen)
+        _hash_update(h, func.args)
+        _hash_update(h, func.keywords)
+    elif hasattr(func, "__wrapped__"):
+        # a decorated function (such as a memoized one) is identified by what it wraps
+        _hash_callable(h, func.__wrapped__, seen)
+    elif isinstance(func, types.MethodType):
+        h.update(b"method")
+        _hash_callable(h, func.__func__, seen)
+        _hash_update(h, func.__self__)
+    elif isinstance(func, types.FunctionType):
+        h.update(f"function{func.__module__}.{func.__qualname__}".encode())
+        _hash_code(h, func.__code__)
+        for value in (func.__defaults__, func.__kwdefaults__):
+            _hash_update(h, value)
+        for cell in func.__closure__ or ():
+            try:
+                value = cell.cell_contents
+            except ValueError:
+                h.update(b"empty cell")
+                continue
+            if callable(value) and not isinstance(value, type):
+                _hash_callable(h, value, seen)
+            else:
+                _hash_update(h, value)
+    elif isinstance(func, (type, types.BuiltinFunctionType, np.ufunc)):
+        # classes and compiled functions are identified by name
+        h.update(f"callable{getattr(func, '__module__', None)}.{getattr(func, '__qualname__', func.__name__)}".encode())
+    else:
+        raise TypeError(f"can't build a cache key for the callable {func!r}")
+
+def _hash_code(h, code):
+    """
+    Feeds the bytecode, constants and names of a code object into the hash object h
+    """
+    h.update(code.co_code)
+    h.update(repr((code.co_names, code.co_varnames, code.co_freevars)).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(h, const)
+        else:
+            _hash_update(h, const)
+
+def array_key(*args, **kwargs):
+    """
+    Returns a hex digest that identifies the supplied arguments by content
+    Two calls with equal arrays/DataFrames and equal parameters get the same key
+    """
+    h = hashlib.blake2b(digest_size=20)
+    _hash_update(h, args)
+    _hash_update(h, kwargs)
+    return h.hexdigest()
+
+def _nbytes(value):
+    """
+    Approximate memory footprint of a cached value in bytes
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True))
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return len(pickle.dumps(value))
+
+def _copy(value):
+    """
+    Returns a copy of value so callers can't mutate what is held in the cache
+    """
+    if isinstance(value, (np.ndarray, pd.Series, pd.DataFrame)):
+        return value.copy()
+    return copy.deepcopy(value)
+
+class ArrayCache:
+    """
+    Least-recently-used cache of function results keyed on array_key()
+    maxsize: maximum number of entries held in memory (0 disables the cache)
+    max_bytes: optional bound on the total size of the entries held in memory
+    path: optional directory where every entry is also pickled, so results survive the session
+    """
+    def __init__(self, maxsize=512, max_bytes=None, path=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.path = path
+        self.enabled = True
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.pkl")
+
+    def get(self, key):
+        """
+        Returns (True, value) if key is cached, in memory or on disk, and (False, None) otherwise
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, _copy(self._entries[key])
+        if self.path is not None and os.path.exists(self._file(key)):
+            with open(self._file(key), "rb") as f:
+                value = pickle.load(f)
+            self._remember(key, value)
+            self.hits += 1
+            self.disk_hits += 1
+            return True, _copy(value)
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        """
+        Stores a copy of value under key, evicting the least recently used entries if needed
+        """
+        value = _copy(value)
+        if self.path is not None:
+            tmp = self._file(key) + ".tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._file(key))
+        self._remember(key, value)
+
+    def _remember(self, key, value):
+        if self.maxsize <= 0:
+            return
+        if key in self._entries:
+            self.nbytes -= self._sizes[key]
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._sizes[key] = _nbytes(value)
+        self.nbytes += self._sizes[key]
+        while len(self._entries) > self.maxsize or (self.max_bytes is not None and self.nbytes > self.max_bytes and len(self._entries) > 1):
+            old_key, _ = self._entries.popitem(last=False)
+            self.nbytes -= self._sizes.pop(old_key)
+            self.evictions += 1
+
+    def clear(self, disk=False):
+        """
+        Drops all the entries held in memory (and on disk if disk=True) and resets the counters
+        """
+        self._entries.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+        self.hits = self.misses = self.disk_hits = self.evictions = 0
+        if disk and self.path is not None:
+            for name in os.listdir(self.path):
+                if name.endswith(".pkl"):
+                    os.remove(os.path.join(self.path, name))
+
+    def stats(self):
+        """
+        Returns the hit/miss counters and the current size of the cache as a Series
+        """
+        lookups = self.hits + self.misses
+        return pd.Series({
+            "Hits": self.hits,
+            "Misses": self.misses,
+            "Disk Hits": self.disk_hits,
+            "Hit Rate": self.hits/lookups if lookups else np.nan,
+            "Entries": len(self._entries),
+            "Bytes": self.nbytes,
+            "Evictions": self.evictions
+        })
+
+# shared by the optimizers and covariance estimators below, bounded to 256MB of results
+memo_cache = ArrayCache(max_bytes=256*2**20)
+
+def memoize(cache=None, ignore=("state",)):
+    """
+    Decorator that caches the results of func in an ArrayCache (memo_cache by default)
+    The key is built from the content of the bound arguments, so positional and keyword
+    calls share entries. Arguments named in "ignore" (the WarmStart state) don't take part in the key,
+    and a call that passes one of them bypasses the cache, since the function has to update it.
+    Arguments that can't be hashed simply bypass the cache too
+    """
+    def decorator(func):
+        sig = inspect.signature(func)
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            store = wrapper.cache
+            if not store.enabled or (store.maxsize <= 0 and store.path is None):
+                return func(*args, **kwargs)
+            try:
+                bound = sig.bind(*args, **kwargs)
+                bound.apply_defaults()
+                keyed = {}
+                stateful = False
+                for name, value in bound.arguments.items():
+                    if name in ignore:
+                        stateful = stateful or value is not None
+                        continue
+                    if sig.parameters[name].kind is inspect.Parameter.VAR_KEYWORD:
+                        stateful = stateful or any(value.get(k) is not None for k in ignore)
+                        value = {k: v for k, v in value.items() if k not in ignore}
+                    keyed[name] = value
+                if stateful:
+                    return func(*args, **kwargs)
+                key = array_key(func.__module__, func.__qualname__, **keyed)
+            except (TypeError, AttributeError, pickle.PicklingError):
+                return func(*args, **kwargs)
+            found, value = store.get(key)
+            if found:
+                return value
+            value = func(*args, **kwargs)
+            store.put(key, value)
+            return value
+        wrapper.cache = memo_cache if cache is None else cache
+        return wrapper
+    return decorator
+
+
 def portfolio_return(weights, returns):
     """
     Computes the return on a portfolio from constituent returns and weights
@@ -290,29 +579,396 @@ def plot_ef2(n_points, er, cov):
     return ef.plot.line(x="Volatility", y="Returns", style=".-")
 
 
-from scipy.optimize import minimize
+from scipy.optimize import minimize, linprog
+import json
+import time
+from collections import deque
+
+class SolverLog:
+    """
+    In-process registry of the optimizer calls made by this module: one record per solve with
+    the caller, the solver, its status and message, the iteration, function and gradient
+    evaluation counts, the wall time and the largest constraint violation at the returned point
+    maxlen: number of records kept, the oldest ones are dropped first
+    """
+    def __init__(self, maxlen=100000):
+        self.enabled = True
+        self.records = deque(maxlen=maxlen)
+
+    def record(self, caller, solver, result, elapsed, violation=np.nan):
+        """
+        Adds the record of one solve, given its scipy OptimizeResult
+        """
+        if not self.enabled:
+            return
+        count = lambda name: int(result[name]) if name in result else None
+        self.records.append({
+            "caller": caller,
+            "solver": solver,
+            "success": bool(result.get("success", False)),
+            "status": int(result.get("status", -1)),
+            "message": str(result.get("message", "")),
+            "nit": count("nit"),
+            "nfev": count("nfev"),
+            "njev": count("njev"),
+            "wall_time": float(elapsed),
+            "violation": float(violation),
+        })
+
+    def clear(self):
+        """
+        Drops all the records
+        """
+        self.records.clear()
+
+    def to_frame(self):
+        """
+        Returns the records as a DataFrame, one row per solve
+        """
+        columns = ["caller", "solver", "success", "status", "message", "nit", "nfev", "njev", "wall_time", "violation"]
+        return pd.DataFrame(list(self.records), columns=columns)
+
+    def to_json(self, path=None):
+        """
+        Returns the records as a JSON string, or writes them to path if given
+        """
+        text = json.dumps(list(self.records), allow_nan=True)
+        if path is None:
+            return text
+        with open(path, "w") as f:
+            f.write(text)
+
+    def summary(self):
+        """
+        Returns the number of calls, failures, mean iterations, total wall time
+        and worst constraint violation per caller as a DataFrame
+        """
+        df = self.to_frame()
+        df["failed"] = ~df["success"].astype(bool)
+        return df.groupby("caller").agg(calls=("success", "size"), failures=("failed", "sum"),
+                                        mean_nit=("nit", "mean"), wall_time=("wall_time", "sum"),
+                                        max_violation=("violation", "max"))
+
+# every minimize/linprog call below goes through _run_solver and is recorded here
+solver_log = SolverLog()
+
+def _constraint_violation(x, constraints=(), bounds=None):
+    """
+    Largest violation of scipy-style constraint dicts and bounds at x
+    """
+    worst = 0.0
+    for c in constraints:
+        value = np.atleast_1d(c['fun'](x))
+        if len(value):
+            worst = max(worst, np.abs(value).max() if c['type'] == 'eq' else np.maximum(-value, 0).max())
+    if bounds is not None:
+        lo = np.array([-np.inf if b[0] is None else b[0] for b in bounds])
+        hi = np.array([np.inf if b[1] is None else b[1] for b in bounds])
+        worst = max(worst, np.maximum(lo - x, 0).max(), np.maximum(x - hi, 0).max())
+    return float(worst)
+
+def _run_solver(caller, solver, *args, **kwargs):
+    """
+    Calls solver (scipy's minimize or linprog) and records the solve in solver_log under caller
+    """
+    start = time.perf_counter()
+    result = solver(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    if solver_log.enabled:
+        if solver is linprog:
+            # HiGHS reports the equality residuals and the inequality slacks
+            violation = np.nan if result.x is None else max(
+                np.abs(np.asarray(result.get("con", []))).max(initial=0.0),
+                np.maximum(-np.asarray(result.get("slack", [])), 0).max(initial=0.0))
+        else:
+            violation = _constraint_violation(result.x, kwargs.get("constraints", ()), kwargs.get("bounds"))
+        solver_log.record(caller, kwargs.get("method", solver.__name__), result, elapsed, violation)
+    return result
+
+class WarmStart:
+    """
+    State carried from one estimation window to the next by backtest_ws
+    x0: the previous solution, used as the starting point of the next solve
+    store: scratch space where estimators can keep factorizations etc. between windows
+    Solver iterations are counted either way; with warm=False the solves
+    start from 1/n as usual, which gives the baseline to compare against
+    """
+    def __init__(self, warm=True):
+        self.warm = warm
+        self.x0 = None
+        self.store = {}
+        self.n_solves = 0
+        self.n_iterations = 0
+
+    def initial_guess(self, n):
+        """
+        Returns the previous solution if there is a usable one, else the equal weights
+        """
+        if self.warm and self.x0 is not None and len(self.x0) == n and np.isfinite(self.x0).all():
+            return self.x0
+        return np.repeat(1/n, n)
+
+    def record(self, result):
+        """
+        Counts the iterations of a scipy OptimizeResult and keeps its solution for the next solve
+        """
+        self.n_solves += 1
+        self.n_iterations += result.nit
+        self.x0 = result.x
+
+    def update(self, weights):
+        """
+        Keeps the weights actually used as the starting point of the next solve
+        """
+        weights = np.asarray(weights, dtype=float)
+        if np.isfinite(weights).all():
+            self.x0 = weights
+
+    def summary(self):
+        """
+        Returns the solve and iteration counts as a dict
+        """
+        return {"solves": self.n_solves, "iterations": self.n_iterations,
+                "iterations_per_solve": self.n_iterations/self.n_solves if self.n_solves else np.nan}
+
+def _initial_guess(n, state=None):
+    """
+    Equal weights, or the warm start held in state if there is one
+    """
+    return np.repeat(1/n, n) if state is None else state.initial_guess(n)
+
+class PortfolioConstraints:
+    """
+    Linear constraints on the weights of a portfolio of n assets:
+    per-asset bounds, a budget, group/sector caps, factor exposure bounds and a turnover limit.
+    The constraints are compiled into matrices so that the solvers evaluate all of them
+    with a couple of matrix products instead of one Python callback per constraint.
+    assets: number of assets or their labels (labels let you refer to assets by name)
+    By default the portfolio is long-only and fully invested, as in minimize_vol, msr and gmv
+    """
+    def __init__(self, assets, lower=0.0, upper=1.0, budget=1.0):
+        self.assets = pd.Index(range(assets)) if isinstance(assets, (int, np.integer)) else pd.Index(assets)
+        self.n = len(self.assets)
+        self.lower = np.full(self.n, -np.inf if lower is None else lower, dtype=float)
+        self.upper = np.full(self.n, np.inf if upper is None else upper, dtype=float)
+        self.budget = budget
+        self.rows = [] # list of (coefficients, lower, upper)
+        self.current_weights = None
+        self.max_turnover = None
+
+    def _vector(self, values, default):
+        """
+        Turns a scalar, an array or a dict/Series keyed by asset label into an n-vector,
+        assets missing from a dict/Series keep their value in default (a scalar or an n-vector)
+        """
+        if isinstance(values, (dict, pd.Series)):
+            values = pd.Series(values, dtype=float)
+            unknown = values.index.difference(self.assets)
+            if len(unknown):
+                raise KeyError(f"unknown assets: {list(unknown)}")
+            vec = np.broadcast_to(np.asarray(default, dtype=float), (self.n,)).copy()
+            vec[self.assets.get_indexer(values.index)] = values.to_numpy()
+            return vec
+        return np.broadcast_to(np.asarray(values, dtype=float), (self.n,)).copy()
+
+    def _members(self, members):
+        """
+        Turns a list of asset labels or a boolean mask into a 0/1 coefficient vector
+        """
+        members = np.asarray(members)
+        if members.dtype == bool:
+            return members.astype(float)
+        return self.assets.isin(members).astype(float)
+
+    def bound_assets(self, lower=None, upper=None):
+        """
+        Sets per-asset minimum and/or maximum weights (scalar, array or dict keyed by asset)
+        """
+        if lower is not None:
+            self.lower = self._vector(lower, self.lower)
+        if upper is not None:
+            self.upper = self._vector(upper, self.upper)
+        return self
+
+    def add_linear(self, coefficients, lower=None, upper=None):
+        """
+        Adds lower <= coefficients @ weights <= upper, an equality if lower == upper
+        """
+        coefficients = self._vector(coefficients, 0.0)
+        self.rows.append((coefficients,
+                          -np.inf if lower is None else float(lower),
+                          np.inf if upper is None else float(upper)))
+        return self
+
+    def add_group(self, members, lower=None, upper=None):
+        """
+        Bounds the total weight of a group of assets (list of labels or boolean mask)
+        """
+        return self.add_linear(self._members(members), lower=lower, upper=upper)
+
+    def add_sector_caps(self, sectors, caps):
+        """
+        Caps the total weight of every sector
+        sectors: the sector of each asset (a Series keyed by asset or a sequence in asset order)
+        caps: a single cap for all the sectors or a dict of caps keyed by sector
+        """
+        sectors = pd.Series(sectors).reindex(self.assets) if isinstance(sectors, (dict, pd.Series)) else pd.Series(list(sectors), index=self.assets)
+        for sector in sectors.dropna().unique():
+            cap = caps.get(sector) if isinstance(caps, dict) else caps
+            if cap is not None:
+                self.add_group((sectors == sector).to_numpy(), upper=cap)
+        return self
+
+    def add_exposures(self, exposures, lower=None, upper=None):
+        """
+        Bounds the exposures of the portfolio, exposures @ weights, to one or more factors
+        exposures: an n-vector, or an n x k DataFrame of factor loadings indexed by asset
+        lower, upper: scalars, or per-factor arrays/dicts
+        """
+        if isinstance(exposures, pd.DataFrame):
+            loadings = {f: exposures[f] for f in exposures.columns}
+        else:
+            loadings = {0: exposures}
+        for i, (factor, loading) in enumerate(loadings.items()):
+            lo = lower[factor] if isinstance(lower, dict) else (lower[i] if np.ndim(lower) else lower)
+            hi = upper[factor] if isinstance(upper, dict) else (upper[i] if np.ndim(upper) else upper)
+            self.add_linear(loading, lower=lo, upper=hi)
+        return self
+
+    def limit_turnover(self, current_weights, max_turnover):
+        """
+        Limits sum(|weights - current_weights|) to max_turnover
+        This is linearized with buy and sell variables, weights = current + buys - sells
+        """
+        self.current_weights = self._vector(current_weights, 0.0)
+        self.max_turnover = float(max_turnover)
+        return self
 
-def minimize_vol(target_return, er, cov):
+    def compile(self):
+        """
+        Returns the constraints as matrices over the solver variables
+        x = weights, or x = (weights, buys, sells) if turnover is limited:
+        a dict with A_eq, b_eq, A_ub, b_ub (A_eq @ x == b_eq and A_ub @ x <= b_ub),
+        the variable bounds and the number of assets and variables
+        """
+        n = self.n
+        turnover = self.max_turnover is not None
+        n_vars = 3*n if turnover else n
+        eq_rows, eq_rhs, ub_rows, ub_rhs = [], [], [], []
+        rows = list(self.rows)
+        if self.budget is not None:
+            rows.append((np.ones(n), self.budget, self.budget))
+        for coefficients, lo, hi in rows:
+            row = np.zeros(n_vars)
+            row[:n] = coefficients
+            if lo == hi:
+                eq_rows.append(row)
+                eq_rhs.append(lo)
+                continue
+            if np.isfinite(hi):
+                ub_rows.append(row)
+                ub_rhs.append(hi)
+            if np.isfinite(lo):
+                ub_rows.append(-row)
+                ub_rhs.append(-lo)
+        bounds = [(None if not np.isfinite(lo) else lo, None if not np.isfinite(hi) else hi)
+                  for lo, hi in zip(self.lower, self.upper)]
+        if turnover:
+            eye = np.eye(n)
+            eq_rows.extend(np.hstack([eye, -eye, eye]))
+            eq_rhs.extend(self.current_weights)
+            row = np.zeros(n_vars)
+            row[n:] = 1
+            ub_rows.append(row)
+            ub_rhs.append(self.max_turnover)
+            bounds += [(0.0, self.max_turnover)] * (2*n)
+        return {
+            "A_eq": np.array(eq_rows).reshape(-1, n_vars),
+            "b_eq": np.array(eq_rhs, dtype=float),
+            "A_ub": np.array(ub_rows).reshape(-1, n_vars),
+            "b_ub": np.array(ub_rhs, dtype=float),
+            "bounds": bounds,
+            "n_assets": n,
+            "n_vars": n_vars
+        }
+
+def _minimize_weights(fun, init_guess, args=(), constraints=None, jac=None, extra_eq=None, options=None, caller=None):
+    """
+    Runs SLSQP on fun(weights, *args) over the weights allowed by constraints,
+    a PortfolioConstraints (long-only and fully invested if None).
+    extra_eq is an optional (coefficients, rhs) pair for one more equality, such as a target return.
+    caller names the solve in solver_log (the name of fun by default).
+    Returns the scipy OptimizeResult, with x holding the weights only
+    """
+    n = len(init_guess)
+    if constraints is None:
+        constraints = PortfolioConstraints(n)
+    if constraints.n != n:
+        raise ValueError(f"constraints are defined on {constraints.n} assets, not {n}")
+    compiled = constraints.compile()
+    n_vars = compiled["n_vars"]
+    A_eq, b_eq = compiled["A_eq"], compiled["b_eq"]
+    A_ub, b_ub = compiled["A_ub"], compiled["b_ub"]
+    if extra_eq is not None:
+        row = np.zeros(n_vars)
+        row[:n] = np.asarray(extra_eq[0], dtype=float)
+        A_eq = np.vstack([A_eq, row])
+        b_eq = np.append(b_eq, extra_eq[1])
+    scipy_constraints = []
+    if len(b_eq):
+        scipy_constraints.append({'type': 'eq', 'fun': lambda x: A_eq@x - b_eq, 'jac': lambda x: A_eq})
+    if len(b_ub):
+        scipy_constraints.append({'type': 'ineq', 'fun': lambda x: b_ub - A_ub@x, 'jac': lambda x: -A_ub})
+    x0 = np.asarray(init_guess, dtype=float)
+    objective, gradient = fun, jac
+    if n_vars > n:
+        # lift the starting point and the objective to (weights, buys, sells)
+        trade = x0 - constraints.current_weights
+        x0 = np.concatenate([x0, np.maximum(trade, 0), np.maximum(-trade, 0)])
+        objective = lambda x, *args: fun(x[:n], *args)
+        if jac is not None:
+            gradient = lambda x, *args: np.concatenate([jac(x[:n], *args), np.zeros(n_vars-n)])
+    result = _run_solver(caller or fun.__name__, minimize, objective, x0, args=args, jac=gradient,
+                         method='SLSQP', options={'disp': False, **(options or {})},
+                         constraints=scipy_constraints,
+                         bounds=compiled["bounds"])
+    result.x = result.x[:n]
+    return result
+
+def solve_qp(P, q, constraints=None, init_guess=None, extra_eq=None, caller="solve_qp"):
+    """
+    Minimizes 1/2 w'Pw + q'w over the weights allowed by constraints (a PortfolioConstraints,
+    long-only and fully invested if None), using the analytic gradient Pw + q
+    The objective is divided by the mean of the diagonal of P while solving, so that SLSQP's
+    tolerance and step sizes don't depend on the scale of the (co)variances
+    Returns the scipy OptimizeResult, whose x holds the weights
+    """
+    P = np.asarray(P, dtype=float)
+    q = np.asarray(q, dtype=float)
+    n = P.shape[0]
+    if init_guess is None:
+        init_guess = np.repeat(1/n, n)
+    scale = np.trace(P)/n
+    if not scale > 0:
+        scale = 1.0
+    def objective(w):
+        return (0.5*w@P@w + q@w)/scale
+    def gradient(w):
+        return (P@w + q)/scale
+    result = _minimize_weights(objective, init_guess, constraints=constraints, jac=gradient,
+                               extra_eq=extra_eq, options={'ftol': 1e-12}, caller=caller)
+    result.fun = result.fun*scale
+    return result
+
+def minimize_vol(target_return, er, cov, constraints=None):
     """
     Returns the optimal weights that achieve the target return
     given a set of expected returns and a covariance matrix
+    constraints: optional PortfolioConstraints, long-only and fully invested by default
     """
     n = er.shape[0]
-    init_guess = np.repeat(1/n, n)
-    bounds = ((0.0, 1.0),) * n # an N-tuple of 2-tuples!
-    # construct the constraints
-    weights_sum_to_1 = {'type': 'eq',
-                        'fun': lambda weights: np.sum(weights) - 1
-    }
-    return_is_target = {'type': 'eq',
-                        'args': (er,),
-                        'fun': lambda weights, er: target_return - portfolio_return(weights,er)
-    }
-    weights = minimize(portfolio_vol, init_guess,
-                       args=(cov,), method='SLSQP',
-                       options={'disp': False},
-                       constraints=(weights_sum_to_1,return_is_target),
-                       bounds=bounds)
+    weights = solve_qp(cov, np.zeros(n), constraints=constraints,
+                       extra_eq=(er, target_return), caller="minimize_vol")
     return weights.x
 
 
@@ -323,18 +979,16 @@ def tracking_error(r_a, r_b):
     return np.sqrt(((r_a - r_b)**2).sum())
 
                          
-def msr(riskfree_rate, er, cov):
+@memoize()
+def msr(riskfree_rate, er, cov, state=None, constraints=None):
     """
     Returns the weights of the portfolio that gives you the maximum sharpe ratio
     given the riskfree rate and expected returns and a covariance matrix
+    state: optional WarmStart that supplies the starting point and counts the iterations
+    constraints: optional PortfolioConstraints, long-only and fully invested by default
     """
     n = er.shape[0]
-    init_guess = np.repeat(1/n, n)
-    bounds = ((0.0, 1.0),) * n # an N-tuple of 2-tuples!
-    # construct the constraints
-    weights_sum_to_1 = {'type': 'eq',
-                        'fun': lambda weights: np.sum(weights) - 1
-    }
+    init_guess = _initial_guess(n, state)
     def neg_sharpe(weights, riskfree_rate, er, cov):
         """
         Returns the negative of the sharpe ratio
@@ -344,37 +998,360 @@ def msr(riskfree_rate, er, cov):
         vol = portfolio_vol(weights, cov)
         return -(r - riskfree_rate)/vol
     
-    weights = minimize(neg_sharpe, init_guess,
-                       args=(riskfree_rate, er, cov), method='SLSQP',
-                       options={'disp': False},
-                       constraints=(weights_sum_to_1,),
-                       bounds=bounds)
+    weights = _minimize_weights(neg_sharpe, init_guess,
+                                args=(riskfree_rate, er, cov),
+                                constraints=constraints, caller="msr")
+    if state is not None:
+        state.record(weights)
     return weights.x
 
 
-def gmv(cov):
+@memoize()
+def gmv(cov, state=None, constraints=None):
     """
     Returns the weights of the Global Minimum Volatility portfolio
     given a covariance matrix
+    A LowRankCov is solved by its own O(N K^2) method (long-only and fully invested only)
     """
+    if isinstance(cov, LowRankCov):
+        if constraints is not None:
+            raise ValueError("a LowRankCov only supports the long-only, fully invested GMV")
+        return cov.gmv()
     n = cov.shape[0]
-    return msr(0, np.repeat(1, n), cov)
+    return msr(0, np.repeat(1, n), cov, state=state, constraints=constraints)
+
+
+def _cla_matrices(cov, mean, w, free):
+    """
+    Returns the inverse covariance of the free assets, their covariance with
+    the bounded assets, their expected returns and the weights of the bounded assets
+    """
+    free = np.asarray(free)
+    bounded = np.setdiff1d(np.arange(len(mean)), free)
+    cov_f_inv = np.linalg.inv(cov[np.ix_(free, free)])
+    return cov_f_inv, cov[np.ix_(free, bounded)], mean[free], w[bounded]
+
+def _cla_break_ties(mean):
+    """
+    Returns the expected returns with the ties broken by increments of 1e-7 of their scale:
+    the lambda at which an asset enters or leaves is indeterminate when its expected return
+    equals those of the free assets
+    """
+    scale = np.abs(mean).max() or 1.0
+    order = np.argsort(mean, kind="stable")
+    tied = np.diff(mean[order]) <= 1e-12*scale
+    if not tied.any():
+        return mean
+    # rank of each asset within its run of tied returns
+    run = np.zeros(len(mean))
+    for k in np.flatnonzero(tied):
+        run[k+1] = run[k] + 1
+    broken = mean.copy()
+    broken[order] += 1e-7*scale*run
+    return broken
+
+def _cla_indeterminate(c, a, b):
+    """
+    True where c = b - a is zero up to rounding, as happens when the expected returns of the
+    free assets are all equal: the lambda of the event is then indeterminate
+    """
+    with np.errstate(invalid='ignore'):
+        return ~(np.abs(c) > 1e-9*(np.abs(a) + np.abs(b)))
+
+def _cla_lambdas_in(cov_f_inv, cov_fb, mean_f, w_b, lb_f, ub_f):
+    """
+    Returns, for every free asset, the lambda at which it hits one of its bounds, and that bound
+    (nan where the asset never hits a bound)
+    """
+    ones_f = np.ones(len(mean_f))
+    c4 = cov_f_inv@ones_f
+    c2 = cov_f_inv@mean_f
+    c1 = ones_f@c4
+    c3 = ones_f@c2
+    c = -c1*c2 + c3*c4
+    bound = np.where(c > 0, ub_f, lb_f)
+    l3 = cov_f_inv@cov_fb@w_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lam = ((1 - w_b.sum() + l3.sum())*c4 - c1*(bound + l3))/c
+    return np.where(_cla_indeterminate(c, c1*c2, c3*c4), np.nan, lam), bound
+
+def _cla_lambdas_out(cov, mean, w, free, bounded, cov_f_inv):
+    """
+    Returns, for every bounded asset, the lambda at which it would become free
+    (nan where it never does). Adding asset i to the free set borders the free covariance
+    with one row and column, so its inverse follows from cov_f_inv and the Schur complement s,
+    for all the candidates at once rather than one matrix inversion per candidate
+    """
+    mean_f = mean[free]
+    s_fb = cov[np.ix_(free, bounded)]
+    u = cov_f_inv@s_fb
+    u_sum = u.sum(axis=0)
+    s = cov[bounded, bounded] - (s_fb*u).sum(axis=0)
+    a1 = cov_f_inv.sum(axis=1)
+    w_b = w[bounded]
+    y = s_fb@w_b
+    e1 = u_sum - 1
+    emu = u.T@mean_f - mean[bounded]
+    ex = u.T@y - cov[np.ix_(bounded, bounded)]@w_b + w_b*s
+    l1 = w_b.sum() - w_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c1 = a1.sum() + e1**2/s
+        c2 = -emu/s
+        c3 = a1@mean_f + e1*emu/s
+        c4 = -e1/s
+        l3 = -ex/s
+        l2 = a1@y - w_b*u_sum + e1*ex/s
+        c = -c1*c2 + c3*c4
+        lam = ((1 - l1 + l2)*c4 - c1*(w_b + l3))/c
+        indeterminate = _cla_indeterminate(c, c1*c2, c3*c4)
+    return np.where(indeterminate | ~np.isfinite(lam), np.nan, lam)
+
+def _cla_free_weights(cov_f_inv, cov_fb, mean_f, w_b, lam):
+    """
+    Returns the weights of the free assets on the critical line at lambda
+    """
+    ones_f = np.ones(len(mean_f))
+    w1 = cov_f_inv@cov_fb@w_b
+    g = (-lam*(ones_f@cov_f_inv@mean_f) + 1 - w_b.sum() + w1.sum())/(ones_f@cov_f_inv@ones_f)
+    return -w1 + g*(cov_f_inv@ones_f) + lam*(cov_f_inv@mean_f)
+
+@memoize()
+def critical_line(er, cov, lower=0.0, upper=1.0):
+    """
+    Markowitz's Critical Line Algorithm for the fully invested frontier with per-asset bounds
+    (long-only by default). Returns the turning points of the efficient frontier as a DataFrame
+    of weights, one row per turning point, from the maximum return portfolio down to the
+    Global Minimum Volatility portfolio, indexed by the lambda at which they occur.
+    Between two adjacent turning points the weights are linear in the target return,
+    so every efficient portfolio is exactly the mix of the two turning points around it
+    """
+    assets = er.index if isinstance(er, pd.Series) else pd.RangeIndex(len(er))
+    mean = np.asarray(er, dtype=float)
+    cov = np.asarray(cov, dtype=float)
+    n = len(mean)
+    lb = np.broadcast_to(np.asarray(lower, dtype=float), (n,)).copy()
+    ub = np.broadcast_to(np.asarray(upper, dtype=float), (n,)).copy()
+    if lb.sum() > 1 or ub.sum() < 1:
+        raise ValueError("the bounds don't admit a fully invested portfolio")
+    returns = mean
+    mean = _cla_break_ties(mean)
+    # start from the maximum return portfolio: fill up the highest returns first
+    w = lb.copy()
+    order = np.argsort(mean, kind="stable")
+    i = n
+    while w.sum() < 1:
+        i -= 1
+        w[order[i]] = ub[order[i]]
+    w[order[i]] += 1 - w.sum()
+    free = [int(order[i])]
+    turning_points, lambdas = [w.copy()], [np.inf]
+    while True:
+        bounded = np.setdiff1d(np.arange(n), free)
+        matrices = _cla_matrices(cov, mean, w, free)
+        # case a) one of the free weights hits a bound
+        l_in = None
+        if len(free) > 1:
+            lam, bounds = _cla_lambdas_in(*matrices, lb[free], ub[free])
+            if not np.isnan(lam).all():
+                j = np.nanargmax(lam)
+                l_in, i_in, bound_in = lam[j], free[j], bounds[j]
+        # case b) one of the bounded weights becomes free
+        l_out = None
+        if len(bounded):
+            lam = _cla_lambdas_out(cov, mean, w, free, bounded, matrices[0])
+            # an asset can't be freed at the lambda it was just bounded at (rounding would make it cycle)
+            limit = lambdas[-1] if np.isinf(lambdas[-1]) else lambdas[-1]*(1 - 1e-9)
+            lam[~(lam < limit)] = np.nan
+            if not np.isnan(lam).all():
+                j = np.nanargmax(lam)
+                l_out, i_out = lam[j], bounded[j]
+        if l_in is None and l_out is None and n > 1:
+            # no event can be located at all (e.g. when the free assets have the same expected return,
+            # every lambda is indeterminate), so the current weights can't be taken down to the
+            # minimum variance portfolio: it is solved for directly within the bounds
+            bounds = PortfolioConstraints(n).bound_assets(lb, ub)
+            w = solve_qp(cov, np.zeros(n), constraints=bounds, caller="critical_line").x
+            turning_points.append(w.copy())
+            lambdas.append(0.0)
+            break
+        if (l_in is None or l_in < 0) and (l_out is None or l_out < 0):
+            # no more events: the last turning point is the minimum variance portfolio
+            lam = 0.0
+        elif l_out is None or (l_in is not None and l_in > l_out):
+            lam = l_in
+            free.remove(i_in)
+            w[i_in] = bound_in
+        else:
+            lam = l_out
+            free.append(int(i_out))
+        w[free] = _cla_free_weights(*_cla_matrices(cov, mean, w, free), lam)
+        turning_points.append(w.copy())
+        lambdas.append(lam)
+        if lam == 0:
+            break
+        if len(lambdas) > 10*(n + 1):
+            raise RuntimeError("the critical line does not converge, is the covariance matrix singular?")
+    turning_points = np.array(turning_points)
+    lambdas = np.array(lambdas)
+    # drop the points with numerical errors, then the ones that are not efficient
+    tol = 1e-9
+    valid = ((np.abs(turning_points.sum(axis=1) - 1) < tol)
+             & (turning_points >= lb - tol).all(axis=1)
+             & (turning_points <= ub + tol).all(axis=1))
+    turning_points, lambdas = turning_points[valid], lambdas[valid]
+    rets = turning_points@returns
+    later_max = np.append(np.maximum.accumulate(rets[::-1])[::-1][1:], -np.inf)
+    # a point without a higher return than a later (lower variance) one is not efficient
+    efficient = rets > later_max + tol*np.abs(returns).max()
+    return pd.DataFrame(turning_points[efficient], columns=assets,
+                        index=pd.Index(lambdas[efficient], name="Lambda"))
+
+def cla_weights(target_returns, er, cov, turning_points=None):
+    """
+    Returns the efficient weights for one or several target returns by interpolating
+    between the turning points of the critical line (computed if not supplied).
+    Targets outside of [GMV return, max return] are clipped to that range
+    Returns an array of weights, with one row per target if several targets are given
+    """
+    if turning_points is None:
+        turning_points = critical_line(er, cov)
+    tp = turning_points.to_numpy()
+    # ascending returns, from the GMV portfolio up to the max return portfolio
+    tp = tp[::-1]
+    rets = tp@np.asarray(er, dtype=float)
+    targets = np.clip(np.atleast_1d(np.asarray(target_returns, dtype=float)), rets[0], rets[-1])
+    if len(rets) == 1:
+        weights = np.repeat(tp, len(targets), axis=0)
+    else:
+        k = np.clip(np.searchsorted(rets, targets, side="right") - 1, 0, len(rets) - 2)
+        span = rets[k+1] - rets[k]
+        a = np.divide(targets - rets[k], span, out=np.zeros_like(targets), where=span > 0)
+        weights = (1 - a)[:, None]*tp[k] + a[:, None]*tp[k+1]
+    return weights[0] if np.ndim(target_returns) == 0 else weights
+
+def cla_msr(riskfree_rate, er, cov, turning_points=None):
+    """
+    Returns the weights of the maximum sharpe ratio portfolio, found exactly
+    on the critical line: on each segment between two turning points the
+    sharpe ratio is maximized in closed form
+    """
+    if turning_points is None:
+        turning_points = critical_line(er, cov)
+    mean = np.asarray(er, dtype=float)
+    cov = np.asarray(cov, dtype=float)
+    tp = turning_points.to_numpy()
+    if len(tp) == 1:
+        return tp[0]
+    # w(a) = start + a*d for a in [0, 1] along each segment
+    start, d = tp[1:], tp[:-1] - tp[1:]
+    p = start@mean - riskfree_rate
+    q = d@mean
+    A = np.einsum('ij,jk,ik->i', d, cov, d)
+    B = 2*np.einsum('ij,jk,ik->i', start, cov, d)
+    C = np.einsum('ij,jk,ik->i', start, cov, start)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a_star = (p*B/2 - q*C)/(q*B/2 - p*A)
+    candidates = np.column_stack([np.zeros_like(p), np.ones_like(p), np.clip(np.nan_to_num(a_star), 0, 1)])
+    sharpe = (p[:, None] + q[:, None]*candidates)/np.sqrt(A[:, None]*candidates**2 + B[:, None]*candidates + C[:, None])
+    seg, col = np.unravel_index(np.nanargmax(sharpe), sharpe.shape)
+    return start[seg] + candidates[seg, col]*d[seg]
+
+from concurrent.futures import ProcessPoolExecutor
+
+def _resampled_frontier_chunk(er, cov, n_draws, n_obs, n_points, lower, upper, seed):
+    """
+    Draws n_draws samples of n_obs returns from N(er, cov) in one go, and returns the sum over
+    the draws of the weights of n_points evenly spaced ranks on each draw's efficient frontier
+    """
+    rng = np.random.default_rng(seed)
+    n = len(er)
+    try:
+        factor = np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        eigvals, eigvecs = np.linalg.eigh(cov)
+        factor = eigvecs*np.sqrt(np.maximum(eigvals, 0))
+    samples = er + rng.standard_normal((n_draws, n_obs, n))@factor.T
+    means = samples.mean(axis=1)
+    deviations = samples - means[:, None, :]
+    covs = np.einsum('dti,dtj->dij', deviations, deviations)/(n_obs - 1)
+    total = np.zeros((n_points, n))
+    for mean, sample_cov in zip(means, covs):
+        # bypass the memo cache, every draw is different
+        turning_points = critical_line.__wrapped__(mean, sample_cov, lower=lower, upper=upper)
+        rets = turning_points.to_numpy()@mean
+        total += cla_weights(np.linspace(rets.min(), rets.max(), n_points), mean, sample_cov,
+                             turning_points=turning_points)
+    return total
+
+def resampled_frontier(er, cov, n_points=50, n_samples=1000, n_obs=None, lower=0.0, upper=1.0,
+                       seed=None, n_workers=None, chunk_size=25):
+    """
+    Michaud's resampled efficient frontier.
+    Simulates n_samples histories of n_obs returns from N(er, cov) (same periodicity as er and cov),
+    computes the efficient frontier of each history's estimated moments with the critical line,
+    and averages the weights rank by rank over the n_points evenly spaced frontier ranks.
+    n_obs must exceed the number of assets, or the estimated covariances are singular;
+    it defaults to max(60, 2*n) for n assets.
+    The draws are split in chunks of chunk_size, each with its own child of SeedSequence(seed),
+    and spread over n_workers processes (n_workers=1 runs them in this process), so the result
+    only depends on seed and chunk_size, not on the number of workers.
+    Returns a DataFrame of weights with one row per rank, from the lowest to the highest return
+    """
+    assets = er.index if isinstance(er, pd.Series) else pd.RangeIndex(len(er))
+    er = np.asarray(er, dtype=float)
+    cov = np.asarray(cov, dtype=float)
+    n = len(er)
+    n_obs = max(60, 2*n) if n_obs is None else n_obs
+    if n_obs <= n:
+        raise ValueError(f"n_obs ({n_obs}) must exceed the number of assets ({n}) for the sample covariances to be invertible")
+    n_chunks = -(-n_samples//chunk_size)
+    sizes = [min(chunk_size, n_samples - k*chunk_size) for k in range(n_chunks)]
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    jobs = [(er, cov, size, n_obs, n_points, lower, upper, child) for size, child in zip(sizes, seeds)]
+    if n_workers == 1:
+        totals = [_resampled_frontier_chunk(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            totals = list(pool.map(_resampled_frontier_chunk, *zip(*jobs)))
+    weights = np.sum(totals, axis=0)/n_samples
+    return pd.DataFrame(weights, columns=assets, index=pd.RangeIndex(n_points, name="Rank"))
 
+def _cla_bounds(constraints, n):
+    """
+    Returns the (lower, upper) bounds of a PortfolioConstraints that only holds per-asset
+    bounds and a full investment budget, the only constraints the critical line handles
+    """
+    if constraints is None:
+        return 0.0, 1.0
+    if constraints.rows or constraints.max_turnover is not None or constraints.budget != 1:
+        raise ValueError("the critical line algorithm only supports per-asset bounds and full investment")
+    return constraints.lower, constraints.upper
 
-def optimal_weights(n_points, er, cov):
+@memoize()
+def optimal_weights(n_points, er, cov, constraints=None, method="slsqp"):
     """
     Returns a list of weights that represent a grid of n_points on the efficient frontier
-    """
+    method="cla" reads the points off the critical line instead of solving minimize_vol
+    for every target; the grid then spans the efficient part of the frontier only,
+    from the GMV return up to the maximum return
+    """
+    if method == "cla":
+        lower, upper = _cla_bounds(constraints, er.shape[0])
+        turning_points = critical_line(er, cov, lower=lower, upper=upper)
+        rets = turning_points.to_numpy()@np.asarray(er, dtype=float)
+        target_rs = np.linspace(rets.min(), rets.max(), n_points)
+        return list(cla_weights(target_rs, er, cov, turning_points=turning_points))
     target_rs = np.linspace(er.min(), er.max(), n_points)
-    weights = [minimize_vol(target_return, er, cov) for target_return in target_rs]
+    weights = [minimize_vol(target_return, er, cov, constraints=constraints) for target_return in target_rs]
     return weights
 
 
-def plot_ef(n_points, er, cov, style='.-', legend=False, show_cml=False, riskfree_rate=0, show_ew=False, show_gmv=False):
+def plot_ef(n_points, er, cov, style='.-', legend=False, show_cml=False, riskfree_rate=0, show_ew=False, show_gmv=False, method="slsqp"):
     """
     Plots the multi-asset efficient frontier
+    method="cla" draws it, and locates the MSR and GMV portfolios, from the critical line
     """
-    weights = optimal_weights(n_points, er, cov)
+    weights = optimal_weights(n_points, er, cov, method=method)
     rets = [portfolio_return(w, er) for w in weights]
     vols = [portfolio_vol(w, cov) for w in weights]
     ef = pd.DataFrame({
@@ -385,7 +1362,7 @@ def plot_ef(n_points, er, cov, style='.-', legend=False, show_cml=False, riskfre
     if show_cml:
         ax.set_xlim(left = 0)
         # get MSR
-        w_msr = msr(riskfree_rate, er, cov)
+        w_msr = cla_msr(riskfree_rate, er, cov) if method == "cla" else msr(riskfree_rate, er, cov)
         r_msr = portfolio_return(w_msr, er)
         vol_msr = portfolio_vol(w_msr, cov)
         # add CML
@@ -400,7 +1377,7 @@ def plot_ef(n_points, er, cov, style='.-', legend=False, show_cml=False, riskfre
         # add EW
         ax.plot([vol_ew], [r_ew], color='goldenrod', marker='o', markersize=10)
     if show_gmv:
-        w_gmv = gmv(cov)
+        w_gmv = critical_line(er, cov).to_numpy()[-1] if method == "cla" else gmv(cov)
         r_gmv = portfolio_return(w_gmv, er)
         vol_gmv = portfolio_vol(w_gmv, cov)
         # add EW
@@ -493,6 +1470,80 @@ def summary_stats(r, riskfree_rate=0.03):
         "Max Drawdown": dd
     })
 
+def _align_relative(strategies, benchmarks):
+    """
+    Strategy and benchmark returns (Series or DataFrames) as two numpy arrays over the periods
+    where all of them have returns, with the labels of their columns
+    """
+    s = strategies.to_frame() if isinstance(strategies, pd.Series) else strategies
+    b = benchmarks.to_frame() if isinstance(benchmarks, pd.Series) else benchmarks
+    both = pd.concat([s, b], axis=1, keys=["s", "b"]).dropna()
+    if len(both) < 2:
+        raise ValueError("the strategies and benchmarks have fewer than 2 periods in common")
+    return both["s"].to_numpy(dtype=float), both["b"].to_numpy(dtype=float), s.columns, b.columns, both.index
+
+def relative_stats(strategies, benchmarks, periods_per_year=12):
+    """
+    Return a DataFrame of benchmark-relative stats for every strategy (columns of strategies, such as
+    backtest_ws outputs) against every benchmark (columns of benchmarks, such as weight_cw backtests),
+    with one row per (strategy, benchmark) pair. Only the periods where all of them have returns are used.
+    All the pairs are computed at once on T x strategies x benchmarks arrays of active returns.
+    The Tracking Error here is the annualized volatility of the active returns and the
+    Active Return the difference of the annualized returns
+    """
+    rs, rb, s_labels, b_labels, _ = _align_relative(strategies, benchmarks)
+    t = len(rs)
+    active = rs[:, :, None] - rb[:, None, :]
+    ann_s = np.prod(1+rs, axis=0)**(periods_per_year/t)-1
+    ann_b = np.prod(1+rb, axis=0)**(periods_per_year/t)-1
+    active_return = ann_s[:, None] - ann_b[None, :]
+    te = active.std(axis=0, ddof=1)*np.sqrt(periods_per_year)
+    rs_c, rb_c = rs - rs.mean(axis=0), rb - rb.mean(axis=0)
+    beta = rs_c.T@rb_c/(rb_c**2).sum(axis=0)
+    # capture ratios: mean strategy return over the mean benchmark return, in the up (down) periods of the benchmark
+    up, down = (rb > 0).astype(float), (rb < 0).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        up_capture = rs.T@up/(rb*up).sum(axis=0)
+        down_capture = rs.T@down/(rb*down).sum(axis=0)
+        ir = active_return/te
+    relative_wealth = np.cumprod(1+rs, axis=0)[:, :, None]/np.cumprod(1+rb, axis=0)[:, None, :]
+    active_dd = (relative_wealth/np.maximum.accumulate(relative_wealth, axis=0) - 1).min(axis=0)
+    stats = {
+        "Active Return": active_return,
+        "Tracking Error": te,
+        "Information Ratio": ir,
+        "Beta": beta,
+        "Up Capture": up_capture,
+        "Down Capture": down_capture,
+        "Max Active Drawdown": active_dd
+    }
+    index = pd.MultiIndex.from_product([s_labels, b_labels], names=["Strategy", "Benchmark"])
+    return pd.DataFrame({name: value.reshape(-1) for name, value in stats.items()}, index=index)
+
+def rolling_beta(strategies, benchmarks, window=36):
+    """
+    Rolling beta of every strategy against every benchmark over the trailing window periods,
+    as a DataFrame with (strategy, benchmark) columns. The windowed sums of all the pairs come
+    from cumulative sums of T x strategies x benchmarks arrays, so the cost does not grow with window
+    """
+    rs, rb, s_labels, b_labels, dates = _align_relative(strategies, benchmarks)
+    if window < 2 or window > len(rs):
+        raise ValueError("window must be between 2 and the number of common periods")
+    # centering first keeps the windowed sums from cancelling; it leaves the betas unchanged
+    rs = rs - rs.mean(axis=0)
+    rb = rb - rb.mean(axis=0)
+
+    def windowed(x):
+        c = np.concatenate([np.zeros((1,) + x.shape[1:]), np.cumsum(x, axis=0)])
+        return c[window:] - c[:-window]
+    sum_s, sum_b = windowed(rs), windowed(rb)
+    cov = windowed(rs[:, :, None]*rb[:, None, :]) - sum_s[:, :, None]*sum_b[:, None, :]/window
+    var = windowed(rb**2) - sum_b**2/window
+    beta = np.full((len(rs), len(s_labels), len(b_labels)), np.nan)
+    beta[window-1:] = cov/var[:, None, :]
+    columns = pd.MultiIndex.from_product([s_labels, b_labels], names=["Strategy", "Benchmark"])
+    return pd.DataFrame(beta.reshape(len(rs), -1), index=dates, columns=columns)
+
                          
 def gbm(n_years = 10, n_scenarios=1000, mu=0.07, sigma=0.15, steps_per_year=12, s_0=100.0, prices=True):
     """
@@ -541,25 +1592,79 @@ def portfolio_tracking_error(weights, ref_r, bb_r):
     """
     return tracking_error(ref_r, (weights*bb_r).sum(axis=1))
                          
-def style_analysis(dependent_variable, explanatory_variables):
+def gram_style_weights(gram, xty, yty=0.0, init_guess=None, caller="style_analysis"):
     """
-    Returns the optimal weights that minimizes the Tracking error between
-    a portfolio of the explanatory variables and the dependent variable
+    Returns the long-only, fully invested weights w that minimize the squared tracking error
+    ||y - Xw||^2 = yty - 2 w'xty + w'gram w, given the Gram matrix gram = X'X and xty = X'y.
+    The cost of a solve only depends on the number of styles, not on the number of observations
     """
-    n = explanatory_variables.shape[1]
-    init_guess = np.repeat(1/n, n)
+    n = gram.shape[0]
+    if init_guess is None:
+        init_guess = np.repeat(1/n, n)
     bounds = ((0.0, 1.0),) * n # an N-tuple of 2-tuples!
     # construct the constraints
     weights_sum_to_1 = {'type': 'eq',
-                        'fun': lambda weights: np.sum(weights) - 1
+                        'fun': lambda weights: np.sum(weights) - 1,
+                        'jac': lambda weights: np.ones(n)
     }
-    solution = minimize(portfolio_tracking_error, init_guess,
-                       args=(dependent_variable, explanatory_variables,), method='SLSQP',
-                       options={'disp': False},
-                       constraints=(weights_sum_to_1,),
-                       bounds=bounds)
-    weights = pd.Series(solution.x, index=explanatory_variables.columns)
-    return weights
+    def squared_te(weights):
+        return yty - 2*weights@xty + weights@gram@weights
+    def squared_te_grad(weights):
+        return 2*(gram@weights - xty)
+    solution = _run_solver(caller, minimize, squared_te, init_guess, jac=squared_te_grad, method='SLSQP',
+                           options={'disp': False, 'ftol': 1e-12},
+                           constraints=(weights_sum_to_1,),
+                           bounds=bounds)
+    return solution.x
+
+def style_analysis(dependent_variable, explanatory_variables):
+    """
+    Returns the optimal weights that minimizes the Tracking error between
+    a portfolio of the explanatory variables and the dependent variable
+    The problem is solved as a constrained least squares on the Gram matrix X'X
+    """
+    x = explanatory_variables.to_numpy(dtype=float)
+    y = np.asarray(dependent_variable, dtype=float)
+    weights = gram_style_weights(x.T@x, x.T@y, y@y)
+    return pd.Series(weights, index=explanatory_variables.columns)
+
+def rolling_style_analysis(dependent_variable, explanatory_variables, window=36):
+    """
+    Runs style_analysis over every rolling window of "window" periods.
+    The Gram matrix X'X and the cross products X'y are updated incrementally, one
+    observation in and one out, and each solve starts from the previous window's weights.
+    dependent_variable can be a Series (one fund) or a DataFrame (one fund per column), in which
+    case all the funds share the same Gram matrix.
+    Returns a DataFrame of weights indexed by the last date of each window,
+    with (fund, style) columns if dependent_variable is a DataFrame
+    """
+    x = explanatory_variables.to_numpy(dtype=float)
+    single = isinstance(dependent_variable, pd.Series)
+    y = dependent_variable.to_frame() if single else dependent_variable
+    funds = y.columns
+    y = y.to_numpy(dtype=float)
+    n_periods, n = x.shape
+    if window > n_periods:
+        raise ValueError("window must not be longer than the return history")
+    gram = x[:window].T@x[:window]
+    xty = x[:window].T@y[:window]
+    yty = (y[:window]**2).sum(axis=0)
+    weights = np.empty((n_periods-window+1, len(funds), n))
+    for i, end in enumerate(range(window, n_periods+1)):
+        if end > window:
+            new, old = end-1, end-window-1
+            gram += np.outer(x[new], x[new]) - np.outer(x[old], x[old])
+            xty += np.outer(x[new], y[new]) - np.outer(x[old], y[old])
+            yty += y[new]**2 - y[old]**2
+        for j in range(len(funds)):
+            init_guess = weights[i-1, j] if i > 0 else None
+            weights[i, j] = gram_style_weights(gram, xty[:, j], yty[j], init_guess=init_guess,
+                                               caller="rolling_style_analysis")
+    index = explanatory_variables.index[window-1:]
+    if single:
+        return pd.DataFrame(weights[:, 0, :], index=index, columns=explanatory_variables.columns)
+    columns = pd.MultiIndex.from_product([funds, explanatory_variables.columns])
+    return pd.DataFrame(weights.reshape(len(index), -1), index=index, columns=columns)
 
 
 def ff_analysis(r, factors):
@@ -599,6 +1704,25 @@ def weight_ew(r, cap_weights=None, max_cw_mult=None, microcap_threshold=None, **
             ew = ew/ew.sum() #reweight
     return ew
 
+def weight_ew_batch(starts, columns, cap_weights=None, max_cw_mult=None, microcap_threshold=None, **kwargs):
+    """
+    Vectorized weight_ew: returns the weights of weight_ew for windows starting at each of the
+    dates in "starts", one row per window, computed for all of them at once from the cap weight panel
+    """
+    n = len(columns)
+    ew = np.full((len(starts), n), 1/n)
+    if cap_weights is not None:
+        cw = cap_weights.reindex(index=starts, columns=columns).to_numpy(dtype=float) # starting cap weights
+        ## exclude microcaps
+        if microcap_threshold is not None and microcap_threshold > 0:
+            ew[cw < microcap_threshold] = 0
+            ew = ew/np.nansum(ew, axis=1, keepdims=True)
+        #limit weight to a multiple of capweight
+        if max_cw_mult is not None and max_cw_mult > 0:
+            ew = np.minimum(ew, cw*max_cw_mult)
+            ew = ew/np.nansum(ew, axis=1, keepdims=True) #reweight
+    return ew
+
 def weight_cw(r, cap_weights, **kwargs):
     """
     Returns the weights of the CW portfolio based on the time series of capweights
@@ -606,79 +1730,1208 @@ def weight_cw(r, cap_weights, **kwargs):
     w = cap_weights.loc[r.index[1]]
     return w/w.sum()
 
-def backtest_ws(r, estimation_window=60, weighting=weight_ew, verbose=False, **kwargs):
+def _rebalance_mask(index, rebalance):
+    """
+    Boolean mask over index of the periods at which the weights are re-estimated:
+    every period if rebalance is None, the first period of each month/quarter/year for "M", "Q", "A",
+    or the periods in a list of dates. The first period is always a rebalance
+    """
+    if rebalance is None:
+        return np.ones(len(index), dtype=bool)
+    if isinstance(rebalance, str):
+        freq = {"A": "Y", "Y": "Y", "Q": "Q", "M": "M"}.get(rebalance.upper())
+        if freq is None:
+            raise ValueError(f"unknown rebalance frequency {rebalance!r}, use 'M', 'Q' or 'A'")
+        periods = index.asfreq(freq) if isinstance(index, pd.PeriodIndex) else pd.DatetimeIndex(index).to_period(freq)
+        mask = np.ones(len(index), dtype=bool)
+        mask[1:] = periods[1:] != periods[:-1]
+        return mask
+    dates = pd.Index(rebalance)
+    if isinstance(index, pd.PeriodIndex) and not isinstance(dates, pd.PeriodIndex):
+        dates = pd.PeriodIndex(dates, freq=index.freq)
+    elif isinstance(index, pd.DatetimeIndex) and not isinstance(dates, pd.DatetimeIndex):
+        dates = pd.DatetimeIndex(dates)
+    mask = index.isin(dates)
+    if len(mask):
+        mask[0] = True
+    return mask
+
+def _drift(targets, is_rebalance, x):
+    """
+    Weights held in each period by a portfolio that trades to targets (one row per rebalance period,
+    flagged by is_rebalance) and lets its weights drift with the asset returns x in between
+    """
+    # position of the last rebalance at or before each period
+    segment = np.cumsum(is_rebalance) - 1
+    last = np.flatnonzero(is_rebalance)[segment]
+    growth = np.vstack([np.zeros(x.shape[1]), np.cumsum(np.log1p(x), axis=0)])
+    # the last targets, drifted since the rebalance
+    held = targets[segment]*np.exp(growth[:-1] - growth[last])
+    return np.where(is_rebalance[:, None], held, held/held.sum(axis=1, keepdims=True))
+
+def _save_checkpoint(path, progress):
+    """
+    Pickles the progress of a backtest to path, atomically so that a crash can't corrupt the previous checkpoint
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(progress, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+def backtest_weights(r, estimation_window=60, weighting=weight_ew, rebalance=None, checkpoint=None, checkpoint_every=12, **kwargs):
+    """
+    Returns the weights held in each period of a backtest of the weighting scheme, as a DataFrame,
+    and the list of rebalance dates at which they were re-estimated (see backtest_ws for the arguments).
+    Between rebalance dates the weights drift with the asset returns.
+    checkpoint: optional file where the progress (the weights so far, the last target and the
+        WarmStart state) is saved every checkpoint_every windows; if the file already holds the
+        progress of the same backtest, it carries on from there
+    """
+    threshold = rebalance if isinstance(rebalance, (int, float)) and not isinstance(rebalance, bool) else None
+    index = r.iloc[estimation_window:].index
+    mask = _rebalance_mask(index, None if threshold is not None else rebalance)
+    if threshold is not None:
+        mask[1:] = False
+    x = r.to_numpy(dtype=float)
+    weights = np.empty((len(index), r.shape[1]))
+    rebalance_dates = []
+    target = None
+    first = 0
+    state = kwargs.get("state")
+    if checkpoint is not None:
+        args = {"r": r, "estimation_window": estimation_window, "weighting": weighting, "rebalance": rebalance,
+                "checkpoint_every": checkpoint_every, "kwargs": {k: v for k, v in kwargs.items() if k != "state"}}
+        key = array_key(**args)
+        if os.path.exists(checkpoint):
+            with open(checkpoint, "rb") as f:
+                saved = pickle.load(f)
+            if saved["key"] != key:
+                raise ValueError(f"{checkpoint} holds the checkpoint of a different backtest")
+            first = saved["next"]
+            weights[:first] = saved["weights"]
+            rebalance_dates = saved["rebalance_dates"]
+            target = saved["target"]
+            if state is not None and saved["state"] is not None:
+                state.__dict__.update(saved["state"].__dict__)
+    elif weighting is weight_ew and threshold is None:
+        # the targets of all the rebalance dates at once, and the drift in between
+        targets = weight_ew_batch(r.index[:len(index)][mask], r.columns, **kwargs)
+        weights = _drift(targets, mask, np.nan_to_num(x[estimation_window:]))
+        return pd.DataFrame(weights, index=index, columns=r.columns), list(index[mask])
+    # bypass the memo cache: every window is different, so the lookups would never hit and
+    # would only hold on to copies of the windows' estimates (and a resumed run must compute
+    # exactly what the original run did)
+    enabled = memo_cache.enabled
+    memo_cache.enabled = False
+    try:
+        for start in range(first, len(index)):
+            if start > 0:
+                # let the previous weights drift with the returns they have just earned
+                grown = weights[start-1]*(1 + np.nan_to_num(x[start+estimation_window-1]))
+                weights[start] = grown/grown.sum()
+            if mask[start] or (threshold is not None and np.abs(weights[start] - target).max() > threshold):
+                target = weighting(r.iloc[start:start+estimation_window], **kwargs)
+                if isinstance(target, pd.Series):
+                    target = target.reindex(r.columns)
+                target = np.asarray(target, dtype=float)
+                weights[start] = target
+                rebalance_dates.append(index[start])
+            if checkpoint is not None and ((start+1) % checkpoint_every == 0 or start+1 == len(index)):
+                _save_checkpoint(checkpoint, {"key": key, "args": args, "next": start+1, "weights": weights[:start+1],
+                                              "rebalance_dates": rebalance_dates, "target": target, "state": state})
+    finally:
+        memo_cache.enabled = enabled
+    return pd.DataFrame(weights, index=index, columns=r.columns), rebalance_dates
+
+def backtest_ws(r, estimation_window=60, weighting=weight_ew, verbose=False, warm_start=False, rebalance=None,
+                checkpoint=None, checkpoint_every=12, return_result=False, **kwargs):
     """
     Backtests a given weighting scheme, given some parameters:
     r : asset returns to use to build the portfolio
     estimation_window: the window to use to estimate parameters
     weighting: the weighting scheme to use, must be a function that takes "r", and a variable number of keyword-value arguments
-    """
-    n_periods = r.shape[0]
-    # return windows
-    windows = [(start, start+estimation_window) for start in range(n_periods-estimation_window)]
-    weights = [weighting(r.iloc[win[0]:win[1]], **kwargs) for win in windows]
-    # convert List of weights to DataFrame
-    weights = pd.DataFrame(weights, index=r.iloc[estimation_window:].index, columns=r.columns)
+    warm_start: True (or a WarmStart instance) to pass "state" to the weighting function, so that
+        each window's solve starts from the previous solution; the solve and iteration counts
+        end up in returns.attrs (and in the WarmStart instance if one was supplied).
+        The covariance estimators then also move a RollingCov from window to window
+        instead of rescanning every window
+    rebalance: None to re-estimate the weights every period, "M", "Q" or "A" to re-estimate them
+        at the start of each month, quarter or year, a list of rebalance dates, or a number to
+        re-estimate them whenever a weight has drifted more than that from its target.
+        In between, the weights drift with the asset returns. The number of estimations made
+        and skipped, and the rebalance dates, end up in returns.attrs
+    checkpoint: optional file where the progress is saved every checkpoint_every windows, so that
+        an interrupted run can be finished with resume_backtest(checkpoint), with the same output
+    return_result: True to return a BacktestResult, which also keeps the weight history, instead of the returns
+    """
+    state = WarmStart() if warm_start is True else (warm_start or None)
+    if state is not None:
+        kwargs["state"] = state
+    weights, rebalance_dates = backtest_weights(r, estimation_window, weighting, rebalance=rebalance,
+                                                checkpoint=checkpoint, checkpoint_every=checkpoint_every, **kwargs)
     returns = (weights * r).sum(axis="columns",  min_count=1) #mincount is to generate NAs if all inputs are NAs
+    returns.attrs.update({"estimations": len(rebalance_dates),
+                          "skipped_estimations": len(weights) - len(rebalance_dates),
+                          "rebalance_dates": rebalance_dates})
+    if verbose:
+        print(f"{len(rebalance_dates)} estimations, {len(weights) - len(rebalance_dates)} skipped")
+    if state is not None:
+        returns.attrs.update(state.summary())
+        if verbose:
+            print(f"{state.n_solves} solves, {state.n_iterations} solver iterations")
+    if return_result:
+        return BacktestResult(returns, weights, r, estimation_window)
     return returns
 
-def sample_cov(r, **kwargs):
+def _turnover(weights, x):
+    """
+    Two-way turnover of a T x N weight history, given the T x N asset returns of the same periods
+    """
+    before = np.zeros_like(weights)
+    drifted = weights[:-1]*(1 + x[:-1])
+    before[1:] = drifted/drifted.sum(axis=1, keepdims=True)
+    return np.abs(weights - before).sum(axis=1)
+
+class BacktestResult:
+    """
+    Returns of a backtest_ws run along with its weight history, kept as a dense float32 array
+    with its index and columns, and analytics of the weights computed for all the dates at once
+    returns: the portfolio returns, as returned by backtest_ws
+    r, estimation_window: the asset returns and the window of the backtest
+    """
+    def __init__(self, returns, weights, r, estimation_window):
+        self.returns = returns
+        self.index = weights.index
+        self.columns = weights.columns
+        self.weights_array = weights.to_numpy(dtype=np.float32)
+        self.r = r
+        self.estimation_window = estimation_window
+
+    @property
+    def weights(self):
+        """
+        The weight history as a DataFrame
+        """
+        return pd.DataFrame(self.weights_array, index=self.index, columns=self.columns)
+
+    def turnover(self):
+        """
+        Two-way turnover of each period: the sum of the absolute changes from the previous weights,
+        drifted with the returns they earned, to the current ones (the first period counts as a full purchase)
+        """
+        x = np.nan_to_num(self.r.loc[self.index].to_numpy(dtype=float))
+        return pd.Series(_turnover(self.weights_array.astype(float), x), index=self.index)
+
+    def hhi(self):
+        """
+        Herfindahl-Hirschman concentration index of the weights, sum(w^2), of each period
+        """
+        w = self.weights_array.astype(float)
+        return pd.Series((w**2).sum(axis=1), index=self.index)
+
+    def effective_n(self):
+        """
+        Effective number of assets, 1/HHI, of each period
+        """
+        return 1/self.hhi()
+
+    def risk_contributions(self, cov_estimator=None, **kwargs):
+        """
+        Contributions to risk (see risk_contribution) of the assets in each period, using the covariance
+        of the estimation window that precedes it; cov_estimator can be sample_cov (the default), cc_cov or shrinkage_cov
+        """
+        _, covs = rolling_moments(self.r, self.estimation_window)
+        covs = _cov_batch(covs[:-1], cov_estimator=cov_estimator or sample_cov, **kwargs)
+        return pd.DataFrame(risk_contribution(self.weights_array, covs), index=self.index, columns=self.columns)
+
+def resume_backtest(checkpoint, verbose=False):
+    """
+    Finishes the backtest_ws run that was saving its progress to checkpoint, starting from
+    its last checkpoint, and returns the same result as the uninterrupted run
+    """
+    with open(checkpoint, "rb") as f:
+        saved = pickle.load(f)
+    args = saved["args"]
+    # the WarmStart is overwritten with the saved one by backtest_weights
+    warm_start = WarmStart() if saved["state"] is not None else False
+    return backtest_ws(args["r"], args["estimation_window"], args["weighting"], verbose=verbose, warm_start=warm_start,
+                       rebalance=args["rebalance"], checkpoint=checkpoint, checkpoint_every=args["checkpoint_every"],
+                       **args["kwargs"])
+
+class StreamingBacktest:
+    """
+    Incremental backtest_ws for a live run that receives one period of asset returns at a time.
+    It keeps the estimation window, the WarmStart state of the weighting scheme (warm solver
+    starts and the RollingCov of the covariance estimators, moved by one rank-one update per period),
+    the weights to hold over the next period and the realized performance, and can be saved
+    to and loaded from disk between runs.
+    Fed with the rows of r, it realizes the returns of backtest_ws(r, estimation_window, weighting, warm_start=True, **kwargs)
+    """
+    def __init__(self, estimation_window=60, weighting=weight_ew, **kwargs):
+        self.estimation_window = estimation_window
+        self.weighting = weighting
+        self.kwargs = kwargs
+        self.state = WarmStart()
+        self.window = None
+        self.weights = None
+        self.dates = []
+        self.realized = []
+
+    def update(self, row):
+        """
+        Takes the asset returns of the next period (a Series named after the period), realizes the return
+        of the weights held over it, and estimates the weights for the following period.
+        Returns the new weights and the realized return (None until the first window is full)
+        """
+        row = pd.Series(row, dtype=float)
+        realized = None
+        if self.weights is not None:
+            realized = (self.weights * row).sum(min_count=1)
+            self.dates.append(row.name)
+            self.realized.append(realized)
+        row = row.to_frame().T
+        if self.window is None:
+            self.window = row
+        else:
+            self.window = pd.concat([self.window.iloc[1-self.estimation_window:], row])
+        if len(self.window) == self.estimation_window:
+            weights = self.weighting(self.window, state=self.state, **self.kwargs)
+            if isinstance(weights, pd.Series):
+                weights = weights.reindex(self.window.columns)
+            self.weights = pd.Series(np.asarray(weights, dtype=float), index=self.window.columns)
+        return self.weights, realized
+
+    def extend(self, r):
+        """
+        Feeds the rows of the returns DataFrame r to update() in order and returns self
+        """
+        for label, row in r.iterrows():
+            self.update(row.rename(label))
+        return self
+
+    @property
+    def returns(self):
+        """
+        The realized returns so far as a Series
+        """
+        return pd.Series(self.realized, index=pd.Index(self.dates), dtype=float)
+
+    def wealth(self, start=1.0):
+        """
+        The wealth index of the realized returns
+        """
+        return start*(1 + self.returns.fillna(0)).cumprod()
+
+    def save(self, path):
+        """
+        Saves the strategy, state included, to path
+        """
+        _save_checkpoint(path, self)
+
+    @staticmethod
+    def load(path):
+        """
+        Loads a strategy saved with save()
+        """
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+def simulate_holdings(r, target_weights, linear_cost=0.0, impact_cost=0.0):
+    """
+    Simulates holding a portfolio that trades to target_weights (a DataFrame of weights indexed by
+    rebalance date, the rows being the weights held from that period on) and lets them drift
+    with the returns r in between, charging for every trade, as a fraction of the portfolio value,
+        linear_cost*|trade| + impact_cost*|trade|^1.5
+    i.e. a linear cost (spread, fees) plus a square-root market impact; both can be per-asset Series.
+    The initial purchase counts as a trade. Everything is computed for all the dates at once.
+    Returns a DataFrame with the "Gross" and "Net" returns, the (two-way) "Turnover" and the "Costs"
+    """
+    target_weights = target_weights.reindex(columns=r.columns)
+    index = r.index[r.index.get_loc(target_weights.index[0]):]
+    x = np.nan_to_num(r.loc[index].to_numpy(dtype=float))
+    is_rebalance = index.isin(target_weights.index)
+    targets = target_weights.reindex(index[is_rebalance]).to_numpy(dtype=float)
+    held = _drift(targets, is_rebalance, x)
+    gross = (held*x).sum(axis=1)
+    # weights just before trading: last period's holdings after earning its returns
+    before = np.zeros_like(held)
+    drifted = held[:-1]*(1 + x[:-1])
+    before[1:] = drifted/drifted.sum(axis=1, keepdims=True)
+    trades = np.where(is_rebalance[:, None], np.abs(held - before), 0.)
+    linear = np.asarray(linear_cost.reindex(r.columns) if isinstance(linear_cost, pd.Series) else linear_cost, dtype=float)
+    impact = np.asarray(impact_cost.reindex(r.columns) if isinstance(impact_cost, pd.Series) else impact_cost, dtype=float)
+    costs = (linear*trades + impact*trades**1.5).sum(axis=1)
+    net = (1 - costs)*(1 + gross) - 1
+    return pd.DataFrame({"Gross": gross, "Net": net, "Turnover": trades.sum(axis=1), "Costs": costs}, index=index)
+
+def backtest_holdings(r, estimation_window=60, weighting=weight_ew, rebalance=None, linear_cost=0.0, impact_cost=0.0, **kwargs):
+    """
+    Backtests a weighting scheme like backtest_ws, but as a holdings simulation: the weights drift
+    between rebalance dates and every rebalance pays linear and square-root impact costs on its
+    turnover (see simulate_holdings). Returns the gross and net returns, turnover and costs as a DataFrame
+    """
+    weights, rebalance_dates = backtest_weights(r, estimation_window, weighting, rebalance=rebalance, **kwargs)
+    return simulate_holdings(r, weights.loc[rebalance_dates], linear_cost=linear_cost, impact_cost=impact_cost)
+
+import itertools
+from multiprocessing import shared_memory
+
+def expand_grid(spec):
+    """
+    Expands a parameter spec, a dict of parameter name -> list of values, into the list of all
+    the combinations as dicts. A value that isn't a list is used as is in every combination
+    """
+    names = list(spec)
+    values = [v if isinstance(v, list) else [v] for v in spec.values()]
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+def _param_label(value):
+    """
+    JSON friendly label of a parameter value for the catalog of a GridStore
+    """
+    if callable(value):
+        return getattr(value, "__name__", repr(value))
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return repr(value)
+
+def _same_param(a, b):
+    """
+    True if two values of a grid parameter are the same object or equal scalars
+    """
+    if a is b:
+        return True
+    return isinstance(a, (str, int, float, bool)) and type(a) is type(b) and a == b
+
+class GridStore:
+    """
+    Directory of backtest results keyed by parameters: one compressed .npz per cell holding its
+    columns (returns, weights, rebalance flags), and a catalog.jsonl with the parameters and timings of every cell
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.npz")
+
+    def __contains__(self, key):
+        return os.path.exists(self._file(key))
+
+    def save(self, key, info, **columns):
+        """
+        Stores the columns of a cell and appends its info (parameters, timings...) to the catalog
+        """
+        tmp = self._file(key) + ".tmp.npz"
+        np.savez_compressed(tmp, **columns)
+        os.replace(tmp, self._file(key))
+        with open(os.path.join(self.path, "catalog.jsonl"), "a") as f:
+            f.write(json.dumps({"key": key, **info}) + "\n")
+
+    def load(self, key):
+        """
+        Returns the columns of a cell as a dict of arrays
+        """
+        with np.load(self._file(key)) as data:
+            return dict(data)
+
+    def catalog(self):
+        """
+        Returns the parameters and timings of the stored cells as a DataFrame indexed by key
+        """
+        path = os.path.join(self.path, "catalog.jsonl")
+        if not os.path.exists(path):
+            return pd.DataFrame()
+        with open(path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        return pd.DataFrame(rows).drop_duplicates("key", keep="last").set_index("key")
+
+    def returns(self, keys, index):
+        """
+        Returns the backtest returns of the given cells as a DataFrame with one column per key,
+        aligned on index, the index of the returns the grid was run on
+        """
+        out = {}
+        for key in keys:
+            cell = self.load(key)
+            out[key] = pd.Series(np.nan, index=index)
+            out[key].iloc[int(cell["start"]):] = cell["returns"]
+        return pd.DataFrame(out)
+
+def _share_frame(df):
+    """
+    Copies the values of a DataFrame into a new shared memory block and returns the
+    block and the spec a worker needs to attach to it
+    """
+    values = df.to_numpy(dtype=float)
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    np.ndarray(values.shape, dtype=float, buffer=shm.buf)[:] = values
+    return shm, (shm.name, values.shape, df.index, df.columns)
+
+# shared memory blocks a worker has attached to, kept open for its lifetime
+_attached = {}
+
+def _attach_frame(spec):
+    name, shape, index, columns = spec
+    if name not in _attached:
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    values = np.ndarray(shape, dtype=float, buffer=_attached[name].buf)
+    return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+def _grid_job(frames, params):
+    """
+    Runs one cell of a grid on the shared inputs and returns its columns and timing
+    """
+    shared = {name: _attach_frame(spec) for name, spec in frames.items()}
+    r = shared.pop("r")
+    start = time.perf_counter()
+    weights, rebalance_dates = backtest_weights(r, **shared, **params)
+    returns = (weights * r.loc[weights.index]).sum(axis="columns", min_count=1)
+    elapsed = time.perf_counter() - start
+    columns = {"returns": returns.to_numpy(), "weights": weights.to_numpy(),
+               "rebalance": weights.index.isin(rebalance_dates), "start": len(r) - len(weights)}
+    return columns, elapsed
+
+def run_grid(r, spec, store, n_workers=None, **fixed):
+    """
+    Runs backtest_weights on r for every combination of the parameters in spec (see expand_grid),
+    e.g. {"estimation_window": [36, 60], "weighting": [weight_ew, weight_gmv], "cov_estimator": [sample_cov, shrinkage_cov]},
+    on a pool of n_workers processes (all the cores by default), and saves the returns, weights
+    and timings of every cell to store (a GridStore or a directory). Cells already in the store are not rerun.
+    fixed: parameters shared by all the cells; DataFrames among them (e.g. cap_weights) are handed
+    to the workers through shared memory, like r
+    Returns the catalog of the cells of the grid as a DataFrame indexed by key
+    """
+    if not isinstance(store, GridStore):
+        store = GridStore(store)
+    frames = {name: value for name, value in fixed.items() if isinstance(value, pd.DataFrame)}
+    fixed = {name: value for name, value in fixed.items() if name not in frames}
+    data_key = array_key(r, frames, fixed)
+    cells = {}
+    for params in expand_grid(spec):
+        params = {**fixed, **params}
+        key = array_key(data_key, params)
+        if key in cells and not all(_same_param(value, cells[key][name]) for name, value in params.items()):
+            # two different configurations would share one cell and the second would never run
+            raise ValueError(f"the grid cells {cells[key]} and {params} get the same key")
+        cells[key] = params
+    jobs = {key: params for key, params in cells.items() if key not in store}
+    blocks, specs = [], {}
+    try:
+        for name, df in {"r": r, **frames}.items():
+            shm, specs[name] = _share_frame(df)
+            blocks.append(shm)
+        def save(key, columns, elapsed):
+            info = {name: _param_label(value) for name, value in jobs[key].items()}
+            store.save(key, {**info, "wall_time": elapsed, "rebalances": int(columns["rebalance"].sum())}, **columns)
+        if n_workers == 1 or len(jobs) <= 1:
+            for key, params in jobs.items():
+                save(key, *_grid_job(specs, params))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                futures = {key: pool.submit(_grid_job, specs, params) for key, params in jobs.items()}
+                for key, future in futures.items():
+                    save(key, *future.result())
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return store.catalog().loc[list(cells)]
+
+def warm_start_savings(r, estimation_window=60, weighting=None, **kwargs):
+    """
+    Runs backtest_ws twice, starting every solve from 1/n and then from the previous window's solution,
+    and returns the solve and iteration counts of both runs and the iterations saved.
+    The memo cache is bypassed so both runs actually solve every window
+    """
+    weighting = weight_gmv if weighting is None else weighting
+    enabled = memo_cache.enabled
+    memo_cache.enabled = False
+    try:
+        counts = {}
+        for label, warm in (("Cold", False), ("Warm", True)):
+            state = WarmStart(warm=warm)
+            backtest_ws(r, estimation_window=estimation_window, weighting=weighting, warm_start=state, **kwargs)
+            counts[label] = state.summary()
+    finally:
+        memo_cache.enabled = enabled
+    counts = pd.DataFrame(counts).T
+    counts["iterations_saved"] = counts.loc["Cold", "iterations"] - counts["iterations"]
+    return counts
+
+def _chol_update(L, x, sign=1.0):
+    """
+    Updates (sign=1) or downdates (sign=-1) in place the lower Cholesky factor L of A
+    so that L L' = A + sign*x x', in O(N^2).
+    Returns False, leaving L unusable, if a downdate would make A lose positive definiteness
+    """
+    x = np.array(x, dtype=float)
+    n = len(x)
+    for k in range(n):
+        r2 = L[k, k]**2 + sign*x[k]**2
+        if not r2 > 0:
+            return False
+        r = np.sqrt(r2)
+        c, s = r/L[k, k], x[k]/L[k, k]
+        L[k, k] = r
+        if k+1 < n:
+            L[k+1:, k] = (L[k+1:, k] + sign*s*x[k+1:])/c
+            x[k+1:] = c*x[k+1:] - s*L[k+1:, k]
+    return True
+
+class RollingCov:
+    """
+    Mean and sample covariance of a window of return observations, kept up to date with
+    O(N^2) rank-one updates as observations are added to and removed from the window
+    (Welford's recurrences on the co-moment matrix M2 = sum (x - mean)(x - mean)').
+    Once cholesky() has been called, the Cholesky factor of the covariance is updated along.
+    assets: number of assets or their labels
+    refresh: the moments are recomputed from the window every "refresh" updates to flush rounding drift
+    """
+    def __init__(self, assets, refresh=1000):
+        self.assets = pd.Index(range(assets)) if isinstance(assets, (int, np.integer)) else pd.Index(assets)
+        self.n = len(self.assets)
+        self.refresh = refresh
+        self.rows = deque()
+        self.labels = deque()
+        self.n_obs = 0
+        self.mean = np.zeros(self.n)
+        self.m2 = np.zeros((self.n, self.n))
+        self._chol = None # lower factor of m2
+        self._updates = 0
+
+    def add(self, x, label=None):
+        """
+        Adds one observation at the end of the window
+        """
+        x = np.asarray(x, dtype=float)
+        self.rows.append(x)
+        self.labels.append(label)
+        self.n_obs += 1
+        delta = x - self.mean
+        self.mean += delta/self.n_obs
+        self.m2 += np.outer(delta, x - self.mean)
+        if self._chol is not None and not _chol_update(self._chol, np.sqrt((self.n_obs-1)/self.n_obs)*delta):
+            self._chol = None
+        self._tick()
+
+    def remove(self):
+        """
+        Removes the oldest observation of the window
+        """
+        x = self.rows.popleft()
+        self.labels.popleft()
+        if self.n_obs == 1:
+            self.n_obs = 0
+            self.mean[:] = 0
+            self.m2[:] = 0
+            self._chol = None
+            return
+        delta = x - self.mean
+        self.n_obs -= 1
+        self.mean -= delta/self.n_obs
+        self.m2 -= np.outer(delta, x - self.mean)
+        if self._chol is not None and not _chol_update(self._chol, np.sqrt((self.n_obs+1)/self.n_obs)*delta, sign=-1.0):
+            self._chol = None
+        self._tick()
+
+    def _tick(self):
+        self._updates += 1
+        if self.refresh and self._updates >= self.refresh:
+            self.recompute()
+
+    def recompute(self):
+        """
+        Recomputes the moments (and the Cholesky factor, if one is kept) from the observations in the window
+        """
+        self._updates = 0
+        if self.n_obs == 0:
+            return
+        x = np.array(self.rows)
+        self.n_obs = len(x)
+        self.mean = x.mean(axis=0)
+        xc = x - self.mean
+        self.m2 = xc.T@xc
+        if self._chol is not None:
+            self._chol = None
+            self.cholesky()
+
+    def _reset(self):
+        self.rows.clear()
+        self.labels.clear()
+        self.n_obs = 0
+        self.mean = np.zeros(self.n)
+        self.m2 = np.zeros((self.n, self.n))
+        self._chol = None
+
+    def sync(self, r):
+        """
+        Brings the window in line with the returns DataFrame r, adding and removing observations
+        at both ends when r overlaps the current window, and starting over otherwise.
+        Returns False (and empties the window) if the new observations have missing values
+        """
+        start = None
+        if len(r) and self.n_obs:
+            first = r.index[0]
+            start = next((i for i, label in enumerate(self.labels) if label == first), None)
+        if start is not None:
+            # the windows are taken to be contiguous, so matching both ends of the overlap is enough
+            n_kept = self.n_obs - start
+            if n_kept > len(r) or r.index[n_kept-1] != self.labels[-1]:
+                start = None
+        if start is None:
+            self._reset()
+            n_kept = 0
+        x = r.to_numpy(dtype=float)[n_kept:]
+        if np.isnan(x).any():
+            self._reset()
+            return False
+        if n_kept == 0:
+            # starting over: one pass over the window
+            self.rows.extend(x)
+            self.labels.extend(r.index)
+            self.n_obs = len(x)
+            self.recompute()
+            return True
+        for i, label in enumerate(r.index[n_kept:]):
+            self.add(x[i], label)
+        for _ in range(start or 0):
+            self.remove()
+        return True
+
+    def cov(self):
+        """
+        Returns the sample covariance (ddof=1) of the window as a numpy array
+        """
+        return self.m2/(self.n_obs-1)
+
+    def cholesky(self):
+        """
+        Returns the lower Cholesky factor of the sample covariance of the window,
+        factorizing it on the first call and keeping it updated from then on
+        """
+        if self._chol is None:
+            self._chol = np.linalg.cholesky(self.m2)
+        return self._chol/np.sqrt(self.n_obs-1)
+
+def _window_cov(r, state=None):
+    """
+    Sample covariance of r as a numpy array. With a state (a WarmStart), it is read off the
+    RollingCov kept in state.store, which is moved to r's window with rank-one updates
+    """
+    if state is None:
+        return r.cov().to_numpy()
+    rolling = state.store.get("rolling_cov")
+    if rolling is None or not rolling.assets.equals(r.columns):
+        rolling = state.store["rolling_cov"] = RollingCov(r.columns)
+    if not rolling.sync(r):
+        # missing values: pandas' pairwise covariance
+        return r.cov().to_numpy()
+    return rolling.cov()
+
+@memoize()
+def sample_cov(r, state=None, **kwargs):
     """
     Returns the sample covariance of the supplied returns
+    state: optional WarmStart whose RollingCov is updated instead of rescanning the window
     """
-    return r.cov()
+    if state is None:
+        return r.cov()
+    return pd.DataFrame(_window_cov(r, state), index=r.columns, columns=r.columns)
 
-def weight_gmv(r, cov_estimator=sample_cov, **kwargs):
+def weight_gmv(r, cov_estimator=sample_cov, state=None, **kwargs):
     """
     Produces the weights of the GMV portfolio given a covariance matrix of the returns 
+    state is the WarmStart passed in by backtest_ws, if any
     """
-    est_cov = cov_estimator(r, **kwargs)
-    return gmv(est_cov)
+    est_cov = cov_estimator(r, state=state, **kwargs)
+    w = gmv(est_cov, state=state)
+    if state is not None:
+        state.update(w)
+    return w
 
-def cc_cov(r, **kwargs):
+def _constant_correlation(cov):
     """
-    Estimates a covariance matrix by using the Elton/Gruber Constant Correlation model
+    Constant Correlation covariance with the same variances as cov (a numpy array)
     """
-    rhos = r.corr()
+    sd = np.sqrt(np.diag(cov))
+    rhos = cov/np.outer(sd, sd)
     n = rhos.shape[0]
     # this is a symmetric matrix with diagonals all 1 - so the mean correlation is ...
-    rho_bar = (rhos.values.sum()-n)/(n*(n-1))
+    rho_bar = (rhos.sum()-n)/(n*(n-1))
     ccor = np.full_like(rhos, rho_bar)
     np.fill_diagonal(ccor, 1.)
-    sd = r.std()
-    return pd.DataFrame(ccor * np.outer(sd, sd), index=r.columns, columns=r.columns)
+    return ccor * np.outer(sd, sd)
+
+@memoize()
+def cc_cov(r, state=None, **kwargs):
+    """
+    Estimates a covariance matrix by using the Elton/Gruber Constant Correlation model
+    state: optional WarmStart whose RollingCov is updated instead of rescanning the window
+    """
+    return pd.DataFrame(_constant_correlation(_window_cov(r, state)), index=r.columns, columns=r.columns)
 
-def shrinkage_cov(r, delta=0.5, **kwargs):
+@memoize()
+def shrinkage_cov(r, delta=0.5, state=None, **kwargs):
     """
     Covariance estimator that shrinks between the Sample Covariance and the Constant Correlation Estimators
+    Both are derived from the same sample covariance, which is only computed once
     """
-    prior = cc_cov(r, **kwargs)
-    sample = sample_cov(r, **kwargs)
+    sample = sample_cov(r, state=state, **kwargs)
+    prior = _constant_correlation(sample.to_numpy())
     return delta*prior + (1-delta)*sample
 
+def nearest_psd(cov, min_eigenvalue=1e-10):
+    """
+    Repairs a symmetric matrix that is not positive semidefinite, such as a pairwise-complete
+    covariance: the eigenvalues of the corresponding correlation matrix are clipped at
+    min_eigenvalue and the result is rescaled to unit diagonal, which keeps the original variances.
+    Works on a DataFrame or a numpy array and returns the same type
+    """
+    c = np.asarray(cov, dtype=float)
+    sd = np.sqrt(np.diag(c))
+    values, vectors = np.linalg.eigh(c/np.outer(sd, sd))
+    corr = (vectors*np.maximum(values, min_eigenvalue))@vectors.T
+    d = np.sqrt(np.diag(corr))
+    repaired = corr/np.outer(d, d)*np.outer(sd, sd)
+    if isinstance(cov, pd.DataFrame):
+        return pd.DataFrame(repaired, index=cov.index, columns=cov.columns)
+    return repaired
+
+@memoize()
+def pairwise_cov(r, min_periods=2, repair=True, state=None, **kwargs):
+    """
+    Sample covariance of returns with missing values, each pair of assets using all the periods
+    where both have returns (as pandas' r.cov()), so that assets with short histories do not
+    force dropping rows. All the pairs are computed at once with masked matrix products.
+    min_periods: pairs with fewer common observations are NaN
+    repair: the result is made positive semidefinite with nearest_psd() so it can go straight into
+        gmv and equal_risk_contributions; a ValueError is raised if some pairs are NaN
+    """
+    x = r.to_numpy(dtype=float)
+    valid = ~np.isnan(x)
+    m = valid.astype(float)
+    # centering on the column means first keeps the products from cancelling
+    x = np.where(valid, x - np.nanmean(x, axis=0), 0.)
+    n = m.T@m
+    sx = x.T@m # sx[i, j] is the sum of asset i's returns over the periods where j has returns too
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = (x.T@x - sx*sx.T/n)/(n-1)
+    cov[n < max(min_periods, 2)] = np.nan
+    cov = pd.DataFrame(cov, index=r.columns, columns=r.columns)
+    if repair:
+        if cov.isna().to_numpy().any():
+            raise ValueError("some pairs of assets have fewer than min_periods common observations")
+        cov = nearest_psd(cov)
+    return cov
+
+@memoize()
+def pairwise_cc_cov(r, min_periods=2, state=None, **kwargs):
+    """
+    Constant Correlation covariance (as cc_cov) estimated from the pairwise-complete covariance
+    of returns with missing values. It is positive semidefinite without repair
+    """
+    cov = pairwise_cov(r, min_periods=min_periods, repair=False)
+    if cov.isna().to_numpy().any():
+        raise ValueError("some pairs of assets have fewer than min_periods common observations")
+    return pd.DataFrame(_constant_correlation(cov.to_numpy()), index=r.columns, columns=r.columns)
+
+class EWMACov(RollingCov):
+    """
+    Exponentially weighted mean and covariance of a window of return observations, the newest
+    observation having weight 1 and each older one decaying by 0.5**(1/halflife) per period.
+    Kept up to date like a RollingCov, with one weighted rank-one update per observation added to
+    or removed from the window (West's weighted recurrences on M2 = sum w (x - mean)(x - mean)').
+    The covariance matches pandas' r.ewm(halflife=halflife).cov() (bias corrected) at the last date
+    """
+    def __init__(self, assets, halflife=12, refresh=1000):
+        self.halflife = halflife
+        self.decay = 0.5**(1/halflife)
+        super().__init__(assets, refresh=refresh)
+        self.weight = 0.
+        self.weight2 = 0.
+
+    def add(self, x, label=None):
+        """
+        Adds one observation at the end of the window, decaying the weights of the others
+        """
+        x = np.asarray(x, dtype=float)
+        self.rows.append(x)
+        self.labels.append(label)
+        self.n_obs += 1
+        self.weight = self.decay*self.weight + 1
+        self.weight2 = self.decay**2*self.weight2 + 1
+        self.m2 *= self.decay
+        delta = x - self.mean
+        self.mean += delta/self.weight
+        self.m2 += np.outer(delta, x - self.mean)
+        self._tick()
+
+    def remove(self):
+        """
+        Removes the oldest observation of the window
+        """
+        x = self.rows.popleft()
+        self.labels.popleft()
+        w = self.decay**(self.n_obs-1)
+        self.n_obs -= 1
+        if self.n_obs == 0:
+            self._reset()
+            return
+        self.weight -= w
+        self.weight2 -= w**2
+        delta = x - self.mean
+        self.mean -= w*delta/self.weight
+        self.m2 -= w*np.outer(delta, x - self.mean)
+        self._tick()
+
+    def recompute(self):
+        """
+        Recomputes the moments from the observations in the window
+        """
+        self._updates = 0
+        if self.n_obs == 0:
+            return
+        x = np.array(self.rows)
+        self.n_obs = len(x)
+        w = self.decay**np.arange(self.n_obs-1, -1, -1)
+        self.weight, self.weight2 = w.sum(), (w**2).sum()
+        self.mean = w@x/self.weight
+        xc = x - self.mean
+        self.m2 = (xc*w[:, None]).T@xc
+
+    def _reset(self):
+        super()._reset()
+        self.weight = 0.
+        self.weight2 = 0.
+
+    def cov(self):
+        """
+        Returns the bias corrected exponentially weighted covariance of the window as a numpy array
+        """
+        return self.m2*self.weight/(self.weight**2 - self.weight2)
+
+    def cholesky(self):
+        """
+        Returns the lower Cholesky factor of the covariance of the window
+        """
+        return np.linalg.cholesky(self.cov())
+
+@memoize()
+def ewma_cov(r, halflife=12, state=None, **kwargs):
+    """
+    Exponentially weighted covariance of the returns r, with weights halving every halflife periods
+    going back from the last observation.
+    state: optional WarmStart whose EWMACov is moved to r's window with rank-one updates
+    instead of reweighting the whole window
+    """
+    if r.isna().to_numpy().any():
+        # pandas handles the missing values pairwise
+        return r.ewm(halflife=halflife).cov().loc[r.index[-1]]
+    ewma = state.store.get("ewma_cov") if state is not None else None
+    if ewma is None or ewma.halflife != halflife or not ewma.assets.equals(r.columns):
+        ewma = EWMACov(r.columns, halflife)
+        if state is not None:
+            state.store["ewma_cov"] = ewma
+    ewma.sync(r)
+    return pd.DataFrame(ewma.cov(), index=r.columns, columns=r.columns)
+
+def _window_moments(r, state=None):
+    """
+    Demeaned returns and biased (1/T) sample covariance of r, as numpy arrays.
+    With a state (a WarmStart), the mean and co-moments come from its RollingCov
+    """
+    x = r.to_numpy(dtype=float)
+    if state is not None and not np.isnan(x).any():
+        _window_cov(r, state)
+        rolling = state.store["rolling_cov"]
+        return x - rolling.mean, rolling.m2/rolling.n_obs
+    y = x - np.nanmean(x, axis=0)
+    if np.isnan(y).any():
+        raise ValueError("the shrinkage estimators need returns without missing values")
+    return y, y.T@y/len(y)
+
+def lw_intensity(y, sample):
+    """
+    Ledoit-Wolf (2004) optimal shrinkage intensity of the sample covariance towards the constant
+    correlation matrix, given the T x N demeaned returns y and their biased (1/T) sample covariance.
+    All the sums are matrix products, so the cost is O(T N^2)
+    """
+    t, n = y.shape
+    var = np.diag(sample)
+    sd = np.sqrt(var)
+    prior = _constant_correlation(sample)
+    rho_bar = ((sample/np.outer(sd, sd)).sum() - n)/(n*(n-1))
+    # asymptotic variances of the sample covariances ...
+    y2 = y**2
+    pi_mat = y2.T@y2/t - sample**2
+    # ... their covariances with the sample variances, and the misspecification of the prior
+    theta = (y**3).T@y/t - var[:, None]*sample
+    np.fill_diagonal(theta, 0.)
+    rho = np.trace(pi_mat) + rho_bar*((sd[None, :]/sd[:, None])*theta).sum()
+    gamma = ((prior - sample)**2).sum()
+    if gamma == 0:
+        return 1.
+    return float(max(0., min(1., (pi_mat.sum() - rho)/gamma/t)))
+
+def oas_intensity(t, sample):
+    """
+    Oracle Approximating Shrinkage (Chen, Wiesel, Eldar, Hero 2010) intensity of the sample
+    covariance towards the scaled identity trace(sample)/N I, given the number of observations t
+    """
+    n = sample.shape[0]
+    tr = np.trace(sample)
+    tr2 = (sample**2).sum() # trace(sample @ sample) for a symmetric matrix
+    denominator = (t + 1 - 2/n)*(tr2 - tr**2/n)
+    if denominator <= 0:
+        return 1.
+    return float(min(1., ((1 - 2/n)*tr2 + tr**2)/denominator))
+
+@memoize()
+def lw_cov(r, state=None, **kwargs):
+    """
+    Covariance estimator that shrinks the Sample Covariance towards the Constant Correlation
+    Estimator with the optimal intensity of Ledoit and Wolf (2004), instead of shrinkage_cov's fixed delta.
+    state: optional WarmStart whose RollingCov supplies the window mean and covariance
+    The intensity used is in the result's attrs["delta"]
+    """
+    y, biased = _window_moments(r, state)
+    delta = lw_intensity(y, biased)
+    sample = biased*len(y)/(len(y)-1)
+    cov = pd.DataFrame(delta*_constant_correlation(sample) + (1-delta)*sample, index=r.columns, columns=r.columns)
+    cov.attrs["delta"] = delta
+    return cov
+
+@memoize()
+def oas_cov(r, state=None, **kwargs):
+    """
+    Covariance estimator that shrinks the Sample Covariance towards a multiple of the identity
+    with the Oracle Approximating Shrinkage intensity.
+    state: optional WarmStart whose RollingCov supplies the window mean and covariance
+    The intensity used is in the result's attrs["delta"]
+    """
+    y, biased = _window_moments(r, state)
+    delta = oas_intensity(len(y), biased)
+    sample = biased*len(y)/(len(y)-1)
+    target = np.eye(len(sample))*np.trace(sample)/len(sample)
+    cov = pd.DataFrame(delta*target + (1-delta)*sample, index=r.columns, columns=r.columns)
+    cov.attrs["delta"] = delta
+    return cov
+
+class LowRankCov:
+    """
+    Covariance matrix in low-rank plus diagonal form, loadings @ factor_cov @ loadings.T + diag(specific),
+    for N assets and K factors, as estimated by factor models.
+    Products and solves use the structure (the Woodbury identity), so they cost O(N K^2)
+    and the N x N matrix is never formed, unless it's asked for with to_frame() or np.asarray()
+    """
+    def __init__(self, loadings, factor_cov, specific, assets=None):
+        self.loadings = np.asarray(loadings, dtype=float)
+        self.factor_cov = np.atleast_2d(np.asarray(factor_cov, dtype=float))
+        self.specific = np.asarray(specific, dtype=float)
+        n = self.loadings.shape[0]
+        self.assets = pd.RangeIndex(n) if assets is None else pd.Index(assets)
+        self.shape = (n, n)
+
+    def __matmul__(self, x):
+        x = np.asarray(x, dtype=float)
+        specific = self.specific if x.ndim == 1 else self.specific[:, None]
+        return self.loadings @ (self.factor_cov @ (self.loadings.T @ x)) + specific*x
+
+    def __rmatmul__(self, x):
+        # the matrix is symmetric
+        return (self @ np.asarray(x, dtype=float).T).T
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self.loadings @ self.factor_cov @ self.loadings.T + np.diag(self.specific)
+        return dense if dtype is None else dense.astype(dtype)
+
+    def to_frame(self):
+        """
+        Returns the full N x N covariance matrix as a DataFrame
+        """
+        return pd.DataFrame(np.asarray(self), index=self.assets, columns=self.assets)
+
+    def diagonal(self):
+        """
+        Returns the variances of the assets
+        """
+        return np.einsum("ik,kl,il->i", self.loadings, self.factor_cov, self.loadings) + self.specific
+
+    def subset(self, mask):
+        """
+        Returns the covariance of the assets selected by the boolean mask
+        """
+        return LowRankCov(self.loadings[mask], self.factor_cov, self.specific[mask], self.assets[mask])
+
+    def solve(self, b, extra_diagonal=0.):
+        """
+        Solves (cov + diag(extra_diagonal)) x = b with the Woodbury identity
+            (D + B F B')^-1 = D^-1 - D^-1 B (I + F B'D^-1 B)^-1 F B'D^-1
+        """
+        b = np.asarray(b, dtype=float)
+        d_inv = 1/(self.specific + extra_diagonal)
+        k = self.factor_cov.shape[0]
+        capacitance = np.eye(k) + self.factor_cov @ (self.loadings.T @ (self.loadings*d_inv[:, None]))
+        if b.ndim == 2:
+            d_inv = d_inv[:, None]
+        db = d_inv*b
+        correction = np.linalg.solve(capacitance, self.factor_cov @ (self.loadings.T @ db))
+        return db - d_inv*(self.loadings @ correction)
+
+    def gmv(self, max_iter=None):
+        """
+        Returns the weights of the long-only, fully invested GMV portfolio, found by an active set
+        method whose steps are closed-form GMV solves on the assets with positive weights
+        """
+        n = self.shape[0]
+        free = np.ones(n, dtype=bool)
+        for _ in range(max_iter or 2*n+1):
+            x = self.subset(free).solve(np.ones(free.sum()))
+            w = np.zeros(n)
+            w[free] = x/x.sum()
+            if (w[free] < 0).any():
+                # drop the assets the unconstrained solution wants to short
+                free &= w >= 0
+                continue
+            # KKT: the assets held at 0 must not have a lower marginal variance than the held ones
+            marginal = self @ w
+            violation = np.where(free, 0., w@marginal - marginal)
+            if violation.max() <= 1e-12*abs(w@marginal):
+                return w
+            free[np.argmax(violation)] = True
+        raise RuntimeError("the GMV active set method did not converge")
+
+    def erc(self, tol=1e-12, max_iter=100):
+        """
+        Returns the weights of the equal risk contribution portfolio, found by Newton's method on
+            minimize 1/2 y'cov y - sum(log(y))/n, y > 0
+        (as erc_batch), whose Newton systems are solved with the Woodbury identity
+        """
+        n = self.shape[0]
+        b = 1/n
+        y = 1/np.sqrt(self.diagonal())
+        y = y/np.sqrt(y @ (self @ y))
+        for _ in range(max_iter):
+            grad = self @ y - b/y
+            if np.abs(grad*y).max() < tol:
+                break
+            step = self.solve(grad, extra_diagonal=b/y**2)
+            # damp the step so that y stays positive
+            shrinking = step > 0
+            t = min(1.0, 0.9*(y[shrinking]/step[shrinking]).min()) if shrinking.any() else 1.0
+            y = y - t*step
+        return y/y.sum()
+
+@memoize()
+def factor_cov(r, factors=None, state=None, **kwargs):
+    """
+    Factor model covariance estimator: regresses the returns of all the assets on the factor
+    returns (e.g. the Fama-French factors from get_fff_returns(), without "RF") in a single
+    least squares solve, and returns loadings @ cov(factors) @ loadings.T + diag(residual variances)
+    as a LowRankCov. The index of r must be a subset of the index of factors
+    """
+    if factors is None:
+        raise ValueError("factor_cov needs the factor returns, e.g. factors=get_fff_returns()[['Mkt-RF', 'SMB', 'HML']]")
+    f = factors.loc[r.index].to_numpy(dtype=float)
+    y = r.to_numpy(dtype=float)
+    if np.isnan(y).any() or np.isnan(f).any():
+        raise ValueError("factor_cov needs returns and factors without missing values")
+    t, k = f.shape
+    x = np.column_stack([np.ones(t), f])
+    coefs, _, _, _ = np.linalg.lstsq(x, y, rcond=None)
+    residuals = y - x @ coefs
+    specific = (residuals**2).sum(axis=0)/(t - k - 1)
+    return LowRankCov(coefs[1:].T, np.cov(f, rowvar=False), specific, assets=r.columns)
+
+import warnings
+
+def top_eigenpairs(y, k, start=None, oversample=5, tol=1e-10, max_iter=200, seed=None):
+    """
+    Top k eigenvalues and eigenvectors of the sample covariance y'y/(T-1) of the T x N demeaned
+    returns y, by randomized subspace iteration on y itself: the N x N matrix is never formed and
+    each iteration costs O(T N (k+oversample)).
+    start: optional N x (k+oversample) subspace to start from, such as the one returned by the
+        previous call on an overlapping window, instead of a random one
+    Returns the eigenvalues (largest first), the eigenvectors as columns, the subspace and the number of iterations
+    """
+    t, n = y.shape
+    m = min(k + oversample, n)
+    if start is not None and start.shape == (n, m):
+        q = start
+    else:
+        q = np.random.default_rng(seed).standard_normal((n, m))
+    q, _ = np.linalg.qr(q)
+    previous = None
+    for iteration in range(1, max_iter+1):
+        z = y.T @ (y @ q)/(t-1)
+        # Rayleigh-Ritz on the current subspace
+        values, vectors = np.linalg.eigh(q.T @ z)
+        top = values[::-1][:k]
+        converged = previous is not None and np.abs(top - previous).max() <= tol*abs(top[0])
+        if converged:
+            break
+        previous = top
+        if iteration < max_iter:
+            q, _ = np.linalg.qr(z)
+    else:
+        # the Ritz pairs above are still those of the current q
+        warnings.warn(f"top_eigenpairs did not converge in {max_iter} iterations", RuntimeWarning)
+    order = np.argsort(values)[::-1][:k]
+    return values[order], q @ vectors[:, order], q, iteration
+
+@memoize()
+def pca_cov(r, n_components=3, state=None, seed=0, **kwargs):
+    """
+    Statistical factor model covariance estimator: keeps the top n_components principal components
+    of the sample covariance plus the diagonal of the residual variances, as a LowRankCov, so that
+    weight_gmv and weight_erc can use its O(N K^2) solvers.
+    The components come from top_eigenpairs(), which never forms the N x N sample covariance.
+    state: optional WarmStart; each window's subspace iteration then starts from the previous
+        window's subspace, and the iteration count is kept in state.store["pca_iterations"]
+    """
+    y = r.to_numpy(dtype=float)
+    if np.isnan(y).any():
+        raise ValueError("pca_cov needs returns without missing values")
+    y = y - y.mean(axis=0)
+    t, n = y.shape
+    k = min(n_components, n, t-1)
+    start = state.store.get("pca_subspace") if state is not None else None
+    values, vectors, subspace, iterations = top_eigenpairs(y, k, start=start, seed=seed)
+    if state is not None:
+        state.store["pca_subspace"] = subspace
+        state.store["pca_iterations"] = state.store.get("pca_iterations", 0) + iterations
+    variances = (y**2).sum(axis=0)/(t-1)
+    # floor the residual variances to keep the covariance positive definite
+    specific = np.maximum(variances - (vectors**2) @ values, 1e-10*variances.max())
+    return LowRankCov(vectors, np.diag(values), specific, assets=r.columns)
+
 def risk_contribution(w,cov):
     """
     Compute the contributions to risk of the constituents of a portfolio, given a set of portfolio weights and a covariance matrix
+    Also takes a T x N array of weights and a T x N x N stack of covariance matrices, and returns
+    the T x N contributions of every date at once
     """
+    if np.ndim(w) == 2:
+        w = np.asarray(w, dtype=float)
+        marginal_contrib = np.einsum("tij,tj->ti", np.asarray(cov, dtype=float), w)
+        return marginal_contrib*w/(marginal_contrib*w).sum(axis=1, keepdims=True)
     total_portfolio_var = portfolio_vol(w,cov)**2
     # Marginal contribution of each constituent
     marginal_contrib = cov@w
     risk_contrib = np.multiply(marginal_contrib,w.T)/total_portfolio_var
     return risk_contrib
 
-def target_risk_contributions(target_risk, cov):
+def target_risk_contributions(target_risk, cov, state=None, constraints=None):
     """
     Returns the weights of the portfolio that gives you the weights such
     that the contributions to portfolio risk are as close as possible to
     the target_risk, given the covariance matrix
+    state: optional WarmStart that supplies the starting point and counts the iterations
+    constraints: optional PortfolioConstraints, long-only and fully invested by default
     """
     n = cov.shape[0]
-    init_guess = np.repeat(1/n, n)
-    bounds = ((0.0, 1.0),) * n # an N-tuple of 2-tuples!
-    # construct the constraints
-    weights_sum_to_1 = {'type': 'eq',
-                        'fun': lambda weights: np.sum(weights) - 1
-    }
+    init_guess = _initial_guess(n, state)
     def msd_risk(weights, target_risk, cov):
         """
         Returns the Mean Squared Difference in risk contributions
@@ -687,24 +2940,383 @@ def target_risk_contributions(target_risk, cov):
         w_contribs = risk_contribution(weights, cov)
         return ((w_contribs-target_risk)**2).sum()
     
-    weights = minimize(msd_risk, init_guess,
-                       args=(target_risk, cov), method='SLSQP',
-                       options={'disp': False},
-                       constraints=(weights_sum_to_1,),
-                       bounds=bounds)
+    weights = _minimize_weights(msd_risk, init_guess,
+                                args=(target_risk, cov),
+                                constraints=constraints, caller="target_risk_contributions")
+    if state is not None:
+        state.record(weights)
     return weights.x
 
-def equal_risk_contributions(cov):
+@memoize()
+def equal_risk_contributions(cov, state=None, constraints=None):
     """
     Returns the weights of the portfolio that equalizes the contributions
     of the constituents based on the given covariance matrix
+    A LowRankCov is solved by its own O(N K^2) method (long-only and fully invested only)
     """
+    if isinstance(cov, LowRankCov):
+        if constraints is not None:
+            raise ValueError("a LowRankCov only supports the long-only, fully invested ERC")
+        return cov.erc()
     n = cov.shape[0]
-    return target_risk_contributions(target_risk=np.repeat(1/n,n), cov=cov)
+    return target_risk_contributions(target_risk=np.repeat(1/n,n), cov=cov, state=state, constraints=constraints)
 
-def weight_erc(r, cov_estimator=sample_cov, **kwargs):
+def weight_erc(r, cov_estimator=sample_cov, state=None, **kwargs):
     """
     Produces the weights of the ERC portfolio given a covariance matrix of the returns 
+    state is the WarmStart passed in by backtest_ws, if any
+    """
+    est_cov = cov_estimator(r, state=state, **kwargs)
+    w = equal_risk_contributions(est_cov, state=state)
+    if state is not None:
+        state.update(w)
+    return w
+
+from scipy.cluster.hierarchy import linkage, leaves_list
+from scipy.spatial.distance import squareform
+
+def hrp(cov, linkage_method="single"):
     """
-    est_cov = cov_estimator(r, **kwargs)
-    return equal_risk_contributions(est_cov)
+    Returns the weights of the Hierarchical Risk Parity portfolio (Lopez de Prado) given a covariance matrix:
+    the assets are clustered on the correlation distance sqrt((1-rho)/2), reordered so that
+    similar assets sit next to each other (quasi-diagonalization), and the weights are split
+    top-down between the two halves of every cluster in inverse proportion to their variance.
+    No optimizer is involved. Every cluster is a contiguous block of the reordered matrix,
+    so all the cluster variances of a level come out of one 2-D prefix sum table at once
+    """
+    labels = cov.columns if isinstance(cov, pd.DataFrame) else None
+    cov = np.asarray(cov, dtype=float)
+    n = cov.shape[0]
+    sd = np.sqrt(np.diag(cov))
+    corr = np.clip(cov/np.outer(sd, sd), -1, 1)
+    dist = np.sqrt((1 - corr)/2)
+    np.fill_diagonal(dist, 0)
+    order = leaves_list(linkage(squareform(dist, checks=False), method=linkage_method))
+    # inverse-variance weighted covariance of the reordered assets, and its prefix sums
+    ivar = 1/np.diag(cov)[order]
+    table = np.zeros((n+1, n+1))
+    table[1:, 1:] = (np.outer(ivar, ivar)*cov[np.ix_(order, order)]).cumsum(axis=0).cumsum(axis=1)
+    ivar_sum = np.concatenate([[0], ivar.cumsum()])
+    def cluster_var(a, b):
+        # variance of the inverse-variance portfolio of the reordered assets a..b-1
+        block = table[b, b] - table[a, b] - table[b, a] + table[a, a]
+        return block/(ivar_sum[b] - ivar_sum[a])**2
+    w = np.ones(n)
+    starts, ends = np.array([0]), np.array([n])
+    while len(starts):
+        mids = (starts + ends)//2
+        var_left, var_right = cluster_var(starts, mids), cluster_var(mids, ends)
+        alpha = 1 - var_left/(var_left + var_right)
+        seg_starts = np.concatenate([starts, mids])
+        seg_ends = np.concatenate([mids, ends])
+        lengths = seg_ends - seg_starts
+        positions = np.arange(lengths.sum()) - np.repeat(lengths.cumsum() - lengths, lengths) + np.repeat(seg_starts, lengths)
+        w[positions] *= np.repeat(np.concatenate([alpha, 1 - alpha]), lengths)
+        keep = lengths > 1
+        starts, ends = seg_starts[keep], seg_ends[keep]
+    weights = np.empty(n)
+    weights[order] = w
+    return weights if labels is None else pd.Series(weights, index=labels)
+
+def weight_hrp(r, cov_estimator=sample_cov, linkage_method="single", state=None, **kwargs):
+    """
+    Produces the weights of the HRP portfolio given a covariance matrix of the returns
+    """
+    est_cov = cov_estimator(r, state=state, **kwargs)
+    return hrp(est_cov, linkage_method=linkage_method)
+
+import scipy.sparse as sparse
+
+def _cvar_lp(scenarios, level, constraints, target_return=None):
+    """
+    Solves the Rockafellar-Uryasev linear program for the min-CVaR weights v:
+        minimize var + sum(excess)/(level% * S)
+        s.t. excess_s >= -r_s.v - var, excess >= 0, and the linear constraints on v
+    through its dual, whose only dense block is the N x S scenario matrix:
+        maximize -b_ub.mu + b_eq.lam + lower.rho - upper.sigma
+        s.t. R'pi - A_ub'mu + A_eq'lam + rho - sigma = 0, sum(pi) = 1, 0 <= pi <= 1/(level% * S)
+    The dual has one row per asset rather than one per scenario, which is what keeps
+    100k scenarios tractable; the weights are the multipliers of its asset rows.
+    Returns the weights and the minimal CVaR
+    """
+    r = np.asarray(scenarios, dtype=float)
+    n_scenarios, n = r.shape
+    if constraints is None:
+        constraints = PortfolioConstraints(n)
+    compiled = constraints.compile()
+    n_vars = compiled["n_vars"]
+    A_ub, b_ub = compiled["A_ub"], compiled["b_ub"]
+    A_eq, b_eq = compiled["A_eq"], compiled["b_eq"]
+    if target_return is not None:
+        row = np.zeros((1, n_vars))
+        row[0, :n] = -r.mean(axis=0)
+        A_ub = np.vstack([A_ub, row])
+        b_ub = np.append(b_ub, -target_return)
+    lower = np.array([-np.inf if lo is None else lo for lo, _ in compiled["bounds"]])
+    upper = np.array([np.inf if hi is None else hi for _, hi in compiled["bounds"]])
+    has_lower, has_upper = np.isfinite(lower), np.isfinite(upper)
+    eye = np.eye(n_vars)
+    scenario_block = sparse.vstack([sparse.csr_matrix(r.T), sparse.csr_matrix((n_vars - n, n_scenarios))])
+    asset_rows = sparse.hstack([scenario_block, sparse.csr_matrix(-A_ub.T), sparse.csr_matrix(A_eq.T),
+                                sparse.csr_matrix(eye[:, has_lower]), sparse.csr_matrix(-eye[:, has_upper])])
+    n_cols = asset_rows.shape[1]
+    var_row = sparse.csr_matrix((np.ones(n_scenarios), (np.zeros(n_scenarios, dtype=int), np.arange(n_scenarios))),
+                                shape=(1, n_cols))
+    c = -np.concatenate([np.zeros(n_scenarios), -b_ub, b_eq, lower[has_lower], -upper[has_upper]])
+    bounds = ([(0, 1/(level/100*n_scenarios))]*n_scenarios + [(0, None)]*len(b_ub)
+              + [(None, None)]*len(b_eq) + [(0, None)]*int(has_lower.sum() + has_upper.sum()))
+    result = _run_solver("min_cvar", linprog, c, A_eq=sparse.vstack([asset_rows, var_row], format="csr"),
+                     b_eq=np.append(np.zeros(n_vars), 1), bounds=bounds, method="highs")
+    if result.status != 0:
+        raise ValueError(f"min-CVaR linear program failed: {result.message}")
+    return -result.eqlin.marginals[:n], -result.fun
+
+def min_cvar(scenarios, level=5, target_return=None, constraints=None):
+    """
+    Returns the weights of the portfolio that minimizes the CVaR at "level" percent
+    (same convention as cvar_historic) over a matrix of return scenarios, one row per scenario
+    and one column per asset, e.g. historical returns from get_ind_returns() or simulated ones.
+    target_return: optional floor on the mean scenario return of the portfolio
+    constraints: optional PortfolioConstraints, long-only and fully invested by default
+    Solved exactly as a sparse linear program (in its dual form) with the local HiGHS solver
+    """
+    weights, _ = _cvar_lp(scenarios, level, constraints, target_return=target_return)
+    return weights
+
+def mean_cvar_frontier(scenarios, n_points=20, level=5, constraints=None):
+    """
+    Returns the mean-CVaR efficient frontier over a matrix of return scenarios as a DataFrame
+    with the "Returns" and "CVaR" of n_points portfolios followed by their weights,
+    from the min-CVaR portfolio up to the highest mean return allowed by the constraints
+    """
+    r = np.asarray(scenarios, dtype=float)
+    n = r.shape[1]
+    assets = scenarios.columns if isinstance(scenarios, pd.DataFrame) else pd.RangeIndex(n)
+    mean = r.mean(axis=0)
+    w_min, _ = _cvar_lp(r, level, constraints)
+    # highest attainable mean return under the same constraints
+    compiled = (constraints if constraints is not None else PortfolioConstraints(n)).compile()
+    c = np.zeros(compiled["n_vars"])
+    c[:n] = -mean
+    top = _run_solver("mean_cvar_frontier", linprog, c, A_ub=compiled["A_ub"] if len(compiled["b_ub"]) else None,
+                  b_ub=compiled["b_ub"] if len(compiled["b_ub"]) else None,
+                  A_eq=compiled["A_eq"] if len(compiled["b_eq"]) else None,
+                  b_eq=compiled["b_eq"] if len(compiled["b_eq"]) else None,
+                  bounds=compiled["bounds"], method="highs")
+    targets = np.linspace(w_min@mean, -top.fun, n_points)
+    rows = []
+    for target in targets:
+        weights, cvar = _cvar_lp(r, level, constraints, target_return=target)
+        rows.append(np.concatenate([[weights@mean, cvar], weights]))
+    return pd.DataFrame(rows, columns=["Returns", "CVaR"] + list(assets))
+
+def rolling_moments(r, window):
+    """
+    Returns the means (K x N) and sample covariances (K x N x N) of every window of "window"
+    consecutive returns of r, r[k:k+window] for k = 0..T-window, as numpy arrays.
+    The sums and cross-product sums are accumulated once over the whole history, so each
+    window costs O(N^2) by differencing instead of a fresh r.cov(). The returns are centered
+    on their full-sample mean first, which keeps the differences well conditioned
+    """
+    x = np.asarray(r, dtype=float)
+    n_periods, n = x.shape
+    if window < 2 or window > n_periods:
+        raise ValueError("window must be between 2 and the length of the return history")
+    if np.isnan(x).any():
+        raise ValueError("rolling_moments needs returns without missing values")
+    center = x.mean(axis=0)
+    x = x - center
+    s1 = np.zeros((n_periods+1, n))
+    np.cumsum(x, axis=0, out=s1[1:])
+    s2 = np.zeros((n_periods+1, n, n))
+    np.cumsum(x[:, :, None]*x[:, None, :], axis=0, out=s2[1:])
+    sums = s1[window:] - s1[:-window]
+    cross = s2[window:] - s2[:-window]
+    means = sums/window
+    covs = (cross - window*means[:, :, None]*means[:, None, :])/(window-1)
+    return means + center, covs
+
+def cc_cov_batch(covs):
+    """
+    Constant correlation version (as in cc_cov) of a stack of covariance matrices
+    """
+    n = covs.shape[-1]
+    sd = np.sqrt(np.diagonal(covs, axis1=1, axis2=2))
+    outer_sd = sd[:, :, None]*sd[:, None, :]
+    rho_bar = ((covs/outer_sd).sum(axis=(1, 2)) - n)/(n*(n-1))
+    ccor = np.broadcast_to(rho_bar[:, None, None], covs.shape).copy()
+    ccor[:, np.arange(n), np.arange(n)] = 1.
+    return ccor*outer_sd
+
+def shrinkage_cov_batch(covs, delta=0.5):
+    """
+    Shrinkage (as in shrinkage_cov) of a stack of covariance matrices towards their constant correlation version
+    """
+    return delta*cc_cov_batch(covs) + (1-delta)*covs
+
+def gmv_batch(covs):
+    """
+    Long-only GMV weights of a stack of covariance matrices, one row per matrix.
+    The closed form cov^-1 1 is used wherever it is long-only, which makes it the
+    constrained optimum too; the other windows are solved with gmv()
+    """
+    k, n = covs.shape[:2]
+    x = np.linalg.solve(covs, np.ones((k, n, 1)))[:, :, 0]
+    weights = x/x.sum(axis=1, keepdims=True)
+    for i in np.flatnonzero((weights < 0).any(axis=1) | ~np.isfinite(weights).all(axis=1)):
+        weights[i] = gmv(covs[i])
+    return weights
+
+def erc_batch(covs, tol=1e-12, max_iter=100):
+    """
+    Equal risk contribution weights of a stack of covariance matrices, one row per matrix.
+    All the windows are solved at once by Newton's method on the convex program
+        minimize 1/2 y'cov y - sum(log(y))/n, y > 0
+    whose solution, rescaled to sum to 1, is the (unique) long-only ERC portfolio
+    """
+    k, n = covs.shape[:2]
+    b = 1/n
+    y = 1/np.sqrt(np.diagonal(covs, axis1=1, axis2=2))
+    y = y/np.sqrt(np.einsum("ki,kij,kj->k", y, covs, y))[:, None]
+    active = np.ones(k, dtype=bool)
+    for _ in range(max_iter):
+        ya, ca = y[active], covs[active]
+        grad = np.einsum("kij,kj->ki", ca, ya) - b/ya
+        hess = ca + np.einsum("ki,ij->kij", b/ya**2, np.eye(n))
+        step = np.linalg.solve(hess, grad[:, :, None])[:, :, 0]
+        # damp the step so that y stays positive
+        ratio = np.where(step > 0, ya/np.where(step > 0, step, 1), np.inf).min(axis=1)
+        t = np.minimum(1.0, 0.9*ratio)
+        y[active] = ya - t[:, None]*step
+        done = np.abs(grad*ya).max(axis=1) < tol
+        active[np.flatnonzero(active)[done]] = False
+        if not active.any():
+            break
+    return y/y.sum(axis=1, keepdims=True)
+
+# the covariance estimators _cov_batch has a vectorized version of
+batch_cov_estimators = (sample_cov, cc_cov, shrinkage_cov)
+
+def _cov_batch(covs, cov_estimator=sample_cov, delta=0.5, **kwargs):
+    if cov_estimator is sample_cov:
+        return covs
+    if cov_estimator is cc_cov:
+        return cc_cov_batch(covs)
+    if cov_estimator is shrinkage_cov:
+        return shrinkage_cov_batch(covs, delta)
+    raise ValueError(f"{getattr(cov_estimator, '__name__', cov_estimator)} has no vectorized version, use backtest_ws")
+
+# vectorized counterparts of the weighting schemes, taking the window means and covariances
+# (and the start dates and columns of the windows)
+batch_weightings = {
+    weight_ew: lambda means, covs, starts, columns, **kwargs: weight_ew_batch(starts, columns, **kwargs),
+    weight_gmv: lambda means, covs, **kwargs: gmv_batch(_cov_batch(covs, **kwargs)),
+    weight_erc: lambda means, covs, **kwargs: erc_batch(_cov_batch(covs, **kwargs)),
+    weight_hrp: lambda means, covs, linkage_method="single", **kwargs: np.array(
+        [hrp(c, linkage_method=linkage_method) for c in _cov_batch(covs, **kwargs)]),
+}
+
+def rolling_weights(r, estimation_window=60, weighting=weight_ew, moments=None, **kwargs):
+    """
+    Returns the weights of every period of backtest_rolling as a DataFrame
+    moments: optional (means, covs) of rolling_moments(r, estimation_window), to share them between backtests
+    """
+    if weighting not in batch_weightings:
+        raise ValueError(f"{getattr(weighting, '__name__', weighting)} has no vectorized version, use backtest_ws")
+    means, covs = rolling_moments(r, estimation_window) if moments is None else moments
+    # the last window has no next period to be held over
+    weights = batch_weightings[weighting](means[:-1], covs[:-1], starts=r.index[:-estimation_window],
+                                          columns=r.columns, **kwargs)
+    return pd.DataFrame(weights, index=r.iloc[estimation_window:].index, columns=r.columns)
+
+def backtest_rolling(r, estimation_window=60, weighting=weight_ew, **kwargs):
+    """
+    Same backtest as backtest_ws, with the same arguments, but every window's mean and
+    covariance come from rolling_moments() and the weights of all the windows are computed
+    at once by the vectorized version of the weighting scheme (see batch_weightings).
+    The results match backtest_ws up to the tolerance of its solvers
+    """
+    weights = rolling_weights(r, estimation_window, weighting, **kwargs)
+    return (weights * r).sum(axis="columns", min_count=1)
+
+def _candidate_weights(r, weighting, params, moments=None):
+    """
+    Weights of every period of a backtest of weighting with params, vectorized when possible
+    moments: optional dict of the rolling_moments of r by estimation window, filled as needed,
+    so that candidates with the same window share them
+    """
+    params = dict(params)
+    vectorized = (weighting in batch_weightings and params.get("rebalance") is None
+                  and (weighting is weight_ew or params.get("cov_estimator", sample_cov) in batch_cov_estimators)
+                  # the rolling moments need complete returns, backtest_weights handles missing ones
+                  and not r.isna().to_numpy().any())
+    if not vectorized:
+        return backtest_weights(r, weighting=weighting, **params)[0]
+    params.pop("rebalance", None)
+    shared = None
+    if moments is not None:
+        window = params.get("estimation_window", 60)
+        if window not in moments:
+            moments[window] = rolling_moments(r, window)
+        shared = moments[window]
+    return rolling_weights(r, weighting=weighting, moments=shared, **params)
+
+def walk_forward(r, weighting=weight_gmv, param_grid=None, n_folds=5, train_size=None, objective="vol",
+                 riskfree_rate=0.03, periods_per_year=12, n_workers=None, **fixed):
+    """
+    Walk-forward evaluation of a weighting scheme: the history is split into n_folds consecutive
+    test slices, each preceded by a train slice (everything before it, or its last train_size periods).
+    On each train slice, the parameters in param_grid (see expand_grid, e.g. {"estimation_window": [36, 60],
+    "cov_estimator": [sample_cov, shrinkage_cov], "delta": [0.2, 0.5, 0.8]}) are tuned to minimize the
+    realized volatility (objective="vol") or maximize the Sharpe ratio (objective="sharpe"), and the
+    best ones are evaluated on the following test slice.
+    As the weights of a period only depend on the returns before it, each candidate is backtested
+    once over the whole history (in parallel on n_workers processes, with vectorized backtests when
+    possible) and every fold reuses it.
+    fixed: parameters shared by all the candidates
+    Returns the realized volatility, Sharpe ratio and mean turnover of each test slice as a DataFrame,
+    with the stitched out-of-sample returns in attrs["returns"]
+    """
+    if objective not in ("vol", "sharpe"):
+        raise ValueError("objective must be 'vol' or 'sharpe'")
+    candidates = [{**fixed, **params} for params in expand_grid(param_grid or {})]
+    n_periods = len(r)
+    first_test = train_size if train_size is not None else n_periods//(n_folds+1)
+    bounds = np.linspace(first_test, n_periods, n_folds+1).astype(int)
+    if n_workers == 1 or len(candidates) <= 1:
+        moments = {}
+        all_weights = [_candidate_weights(r, weighting, params, moments) for params in candidates]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            all_weights = list(pool.map(_candidate_weights, [r]*len(candidates), [weighting]*len(candidates), candidates))
+    all_returns = [(weights * r).sum(axis="columns", min_count=1).reindex(r.index) for weights in all_weights]
+    x = np.nan_to_num(r.to_numpy(dtype=float))
+    all_turnover = [pd.Series(_turnover(weights.to_numpy(dtype=float), x[-len(weights):]), index=weights.index).reindex(r.index)
+                    for weights in all_weights]
+    rows, oos = [], []
+    for k in range(n_folds):
+        train = slice(0 if train_size is None else bounds[k]-train_size, bounds[k])
+        test = slice(bounds[k], bounds[k+1])
+        scores = []
+        for returns in all_returns:
+            train_returns = returns.iloc[train].dropna()
+            if len(train_returns) < 2:
+                scores.append(np.nan)
+            elif objective == "vol":
+                scores.append(annualize_vol(train_returns, periods_per_year))
+            else:
+                scores.append(-sharpe_ratio(train_returns, riskfree_rate, periods_per_year))
+        if np.isnan(scores).all():
+            raise ValueError(f"no candidate has enough history in the train slice of fold {k}")
+        best = int(np.nanargmin(scores))
+        test_returns = all_returns[best].iloc[test]
+        oos.append(test_returns)
+        rows.append({"Train Start": r.index[train][0], "Test Start": r.index[test][0], "Test End": r.index[test][-1],
+                     **{name: _param_label(value) for name, value in expand_grid(param_grid or {})[best].items()},
+                     "Train Score": -scores[best] if objective == "sharpe" else scores[best],
+                     "Vol": annualize_vol(test_returns, periods_per_year),
+                     "Sharpe": sharpe_ratio(test_returns, riskfree_rate, periods_per_year),
+                     "Turnover": all_turnover[best].iloc[test].mean()})
+    folds = pd.DataFrame(rows)
+    folds.attrs["returns"] = pd.concat(oos)
+    return folds